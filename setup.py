@@ -40,6 +40,7 @@ setup(
             'qrworkspace=qrgrader.qrworkspace:main',
             'qrtable=qrgrader.qrtable:main',
             'qrsend=qrgrader.qrsender:main',
+            'qrbench=qrgrader.qrbench:main',
         ],
     },
     package_data={
@@ -5,6 +5,20 @@ class Code:
     TYPE_N = 3
     TYPE_O = 4
 
+    # Bumped every time a code changes its page or pdf_page (set_page or a
+    # plain assignment), the page indexes of the CodeSets are rebuilt then
+    version = 0
+
+    # Type of a code by its first character, a digit for the answers
+    TYPES = {"O": TYPE_O, "P": TYPE_P, "Q": TYPE_Q, "N": TYPE_N}
+
+    # Only what can not be derived from data is given, the rest of the fields
+    # are decoded on the first read of any of them and kept in their slots.
+    # The fields a type does not have (the question of a P code...) stay
+    # unset, reading them raises AttributeError
+    DECODED = ("type", "date", "exam", "question", "answer", "number")
+    __slots__ = ("data", "x", "y", "w", "h", "marked", "_page", "_pdf_page") + DECODED
+
     def __init__(self, data, x, y, w, h, page=None, pdf_page=None):
         self.data = data
         self.x = x
@@ -12,44 +26,58 @@ class Code:
         self.w = w
         self.h = h
         self.marked = False
-        self.exam = None
-        self.page = page
-        self.pdf_page = pdf_page
-        if self.data[0] == "O":
-            self.unique = int(self.data[1:10])
-            self.date = int(self.data[1:7])
-            self.exam = int(self.data[7:10])
-            self.question = int(self.data[10:12])
-            self.type = self.TYPE_O
-        elif self.data[0] == "P":
-            self.unique = int(self.data[1:10])
-            self.date = int(self.data[1:7])
-            self.exam = int(self.data[7:10])
-            self.page = int(self.data[10:12])
-            self.type = self.TYPE_P
-        elif self.data[0] == "Q":
-            self.unique = int(self.data[1:10])
-            self.date = int(self.data[1:7])
-            self.exam = int(self.data[7:10])
-            self.page = int(self.data[10:12])
-            self.type = self.TYPE_Q
-        elif self.data[0] == "N":
-            self.unique = int(self.data[1:10])
-            self.date = int(self.data[1:7])
-            self.exam = int(self.data[7:10])
-            self.number = int(self.data[10:12])
-            self.type = self.TYPE_N
-        else:
-            self.unique = int(self.data[0:9])
-            self.date = int(self.data[0:6])
-            self.exam = int(self.data[6:9])
-            self.question = int(self.data[9:11])
-            self.answer = int(self.data[11])
-            if self.answer not in [1, 2, 3, 4]:
-                permut = self.permut[self.question - 1]
-                self.answer = int(permut.index(self.answer)) + 1
-                self.data = self.data[:11] + str(self.answer)
-            self.type = self.TYPE_A
+        self._page = page
+        self._pdf_page = pdf_page
+        if data[0] in "PQ":
+            self._page = int(data[10:12])
+        elif data[11] not in "1234" and data[0] not in "ON":
+            # Answers printed permuted (5 to 8) are stored as 1 to 4
+            self.data = data[:11] + self.inverse[int(data[9:11]) - 1][data[11]]
+
+    def __getattr__(self, name):
+        # Only called for the slots not set yet (or missing for the type)
+        if name == "type":
+            self.decode()
+            return self.type
+        if name in self.DECODED:
+            self.type  # noqa: decodes all the fields if not done yet
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def decode(self):
+        data = self.data
+        first = data[0] > "9"
+        self.date = int(data[first:first + 6])
+        self.exam = int(data[first + 6:first + 9])
+        if not first:
+            self.question, self.answer = int(data[9:11]), int(data[11])
+        elif data[0] == "O":
+            self.question = int(data[10:12])
+        elif data[0] == "N":
+            self.number = int(data[10:12])
+        self.type = self.TYPES.get(data[0], self.TYPE_A)
+
+    @property
+    def page(self):
+        return self._page
+
+    @page.setter
+    def page(self, page):
+        self._page = page
+        Code.version += 1
+
+    @property
+    def pdf_page(self):
+        return self._pdf_page
+
+    @pdf_page.setter
+    def pdf_page(self, page):
+        self._pdf_page = page
+        Code.version += 1
+
+    @property
+    def unique(self):
+        return self.date * 1000 + self.exam
 
     def set_marked(self, marked):
         self.marked = marked
@@ -154,3 +182,6 @@ class Code:
               [8, 6, 7, 5],
               [8, 7, 5, 6],
               [8, 7, 6, 5]]
+
+    # Inverse of permut: inverse[question - 1][printed answer] = answer
+    inverse = [{str(printed): str(answer) for answer, printed in enumerate(permutation, 1)} for permutation in permut]
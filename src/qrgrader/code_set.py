@@ -4,8 +4,24 @@ from qrgrader.code import Code
 
 
 class CodeSet:
+    """Codes by their data, in insertion order.
+
+    select() uses a hash index (value -> codes) for each attribute in INDEXED,
+    built the first time the attribute is selected and kept up to date by
+    append() and remove(). Other attributes (marked, answer...) are just
+    filtered, so they can be changed freely. Exam, type and question never
+    change. Any change of page or pdf_page (set_page or a plain assignment)
+    bumps Code.version, which makes the page indexes (MUTABLE) be built
+    again on their next select; the others are kept.
+    """
+
+    INDEXED = ("exam", "type", "page", "pdf_page", "question")
+    MUTABLE = ("page", "pdf_page")
+
     def __init__(self, codes=None):
         self.codes = {} if codes is None else codes
+        self.indexes = {}
+        self.version = Code.version
 
     def __add__(self, other):
         c = CodeSet()
@@ -14,6 +30,14 @@ class CodeSet:
         return c
 
     def append(self, code):
+        old = self.codes.get(code.data)
+        if self.check_indexes():
+            # A code replaced keeps its place in codes, its buckets can not
+            # do the same if it moves to another one: built again then
+            if old is not None and any(getattr(old, key, None) != getattr(code, key, None) for key in self.indexes):
+                self.indexes.clear()
+            for key, index in self.indexes.items():
+                index.setdefault(getattr(code, key, None), {})[code.data] = code
         self.codes[code.data] = code
 
     def extend(self, codes):
@@ -22,6 +46,7 @@ class CodeSet:
 
     def clear(self):
         self.codes.clear()
+        self.indexes.clear()
 
     def __repr__(self):
         text = str()
@@ -40,31 +65,44 @@ class CodeSet:
 
     def remove(self, code):
         if code.data in self.codes:
+            self.check_indexes() and self.unindex(self.codes[code.data])
             del self.codes[code.data]
 
+    def check_indexes(self):
+        # True if there are indexes to maintain, the page ones are dropped if a code has changed its page
+        if self.version != Code.version:
+            for key in self.MUTABLE:
+                self.indexes.pop(key, None)
+            self.version = Code.version
+        return len(self.indexes) > 0
+
+    def unindex(self, code):
+        for key, index in self.indexes.items():
+            bucket = index.get(getattr(code, key, None))
+            if bucket is not None:
+                bucket.pop(code.data, None)
+
+    def get_index(self, key):
+        self.check_indexes()
+        index = self.indexes.get(key)
+        if index is None:
+            index = self.indexes[key] = {}
+            for code in self.codes.values():
+                index.setdefault(getattr(code, key, None), {})[code.data] = code
+        return index
+
     def select(self, **kwargs):
-        # chatGPT replaced this
-        # filtered = [x for x in self.codes.values() if all(getattr(x, key) == value for key, value in kwargs.items())]
-
-        # with this for efficiency
-        attrs = kwargs.items()
-        filtered = []
-        for x in self.codes.values():
-            match = True
-            for key, value in attrs:
-                if getattr(x, key) != value:
-                    match = False
-                    break
-            if match:
-                filtered.append(x)
-
-        # This also works, but is slightly less efficient
-        # result = CodeSet({code.data: code for code in filtered})
-
-        result = CodeSet()
-        for code in filtered:
-            result.append(code)
-        return result
+        # The smallest bucket of the indexed attributes, filtered by the
+        # rest of the buckets and then by the other attributes: the cost
+        # depends on the result, not on the set
+        candidates = self.codes
+        buckets = [self.get_index(key).get(value, {}) for key, value in kwargs.items() if key in self.INDEXED]
+        for bucket in buckets:
+            candidates = bucket if len(bucket) < len(candidates) else candidates
+        others = [(key, value) for key, value in kwargs.items() if key not in self.INDEXED]
+        return CodeSet({data: code for data, code in candidates.items()
+                        if all(data in bucket for bucket in buckets)
+                        and all(getattr(code, key, None) == value for key, value in others)})
 
     def get(self, code):
         return self.codes.get(code.data)
@@ -83,17 +121,36 @@ class CodeSet:
     def get_answers(self):
         return sorted(list(set([x.answer for x in self.codes.values() if x.type == Code.TYPE_A])))
 
+    @staticmethod
+    def format(code):
+        return code.data + ",{:.2f},{:.2f},{:.2f},{:.2f},{},{},{:d}\n".format(code.x,
+                                                                            code.y,
+                                                                            code.w,
+                                                                            code.h,
+                                                                            code.page,
+                                                                            code.pdf_page,
+                                                                            int(code.marked))
+
+    @staticmethod
+    def parse(line):
+        fields = line.strip().split(",")
+        data, x, y, w, h, page, pdf_page = fields[:7]
+        code = Code(data, float(x), float(y), float(w), float(h), int(page), int(pdf_page))
+        if len(fields) > 7:
+            code.set_marked(int(fields[7]))
+        return code
+
+    def dumps(self):
+        # Same format as the csv files, also used to move codes between processes
+        return "".join(self.format(code) for code in self.codes.values())
+
+    def loads(self, text):
+        for line in text.splitlines():
+            self.append(self.parse(line))
+
     def save(self, file_name):
         with open(file_name, "w", encoding='utf-8') as f:
-            for code in self.codes.values():
-                f.write(
-                    code.data + ",{:.2f},{:.2f},{:.2f},{:.2f},{},{},{:d}\n".format(code.x,
-                                                                                        code.y,
-                                                                                        code.w,
-                                                                                        code.h,
-                                                                                        code.page,
-                                                                                        code.pdf_page,
-                                                                                        int(code.marked)))
+            f.write(self.dumps())
 
     def load(self, file_name):
         if not os.path.exists(file_name):
@@ -101,12 +158,7 @@ class CodeSet:
         #print("Loading codes from {}".format(file_name))
         with open(file_name, "r", encoding='utf-8') as f:
             for line in f:
-                fields = line.strip().split(",")
-                data, x, y, w, h, page, pdf_page = fields[:7]
-                code = Code(data, float(x), float(y), float(w), float(h), int(page), int(pdf_page))
-                if len(fields) > 7:
-                    code.set_marked(int(fields[7]))
-                self.append(code)
+                self.append(self.parse(line))
         return True
 
     def get_date(self):
@@ -127,6 +179,8 @@ class PageCodeSet(CodeSet):
         super().__init__()
         if codeset is not None:
             self.codes = codeset.codes
+            self.indexes = codeset.indexes
+            self.version = codeset.version
 
     def get_q(self):
         return next((x for x in self.codes.values() if x.type == Code.TYPE_Q), None)
@@ -0,0 +1,336 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from qrgrader.code import Code
+
+# Inverse of Code.permut: INVERSE[question - 1, printed answer] = answer (1 to 4)
+INVERSE = np.zeros((len(Code.permut), 10), dtype=np.int8)
+for i, permutation in enumerate(Code.permut):
+    INVERSE[i, permutation] = np.arange(1, 5)
+
+
+class CodeColumns:
+    """Append-only storage of the fields of many codes, one row per code.
+
+    Several CodeTables (a set and its selections) share the same columns,
+    a table is just the list of its rows. Missing values (the page of a
+    code not placed yet, the question of a P code...) are stored as -1.
+    """
+
+    DTYPE = np.dtype([("data", "S16"), ("type", "i1"), ("date", "i4"), ("exam", "i2"), ("page", "i2"),
+                      ("pdf_page", "i2"), ("question", "i1"), ("answer", "i1"), ("number", "i1"),
+                      ("x", "f8"), ("y", "f8"), ("w", "f8"), ("h", "f8"), ("marked", "?")])
+
+    # Type of a code by its first character (a digit for the answers)
+    TYPES = np.full(256, Code.TYPE_A, dtype=np.int8)
+    TYPES[[ord("O"), ord("P"), ord("Q"), ord("N")]] = Code.TYPE_O, Code.TYPE_P, Code.TYPE_Q, Code.TYPE_N
+
+    def __init__(self):
+        self.array = np.zeros(0, dtype=self.DTYPE)
+        self.fields = {name: self.array[name] for name in self.DTYPE.names}
+        self.size = 0
+
+    def reserve(self, n):
+        # Rows for n more codes (capacity doubled, as a list does)
+        if self.size + n > len(self.array):
+            array = np.zeros(max(self.size + n, 2 * len(self.array)), dtype=self.DTYPE)
+            array[:self.size] = self.array[:self.size]
+            self.array = array
+            # Views of each column, a CodeView reads a field without creating them
+            self.fields = {name: array[name] for name in self.DTYPE.names}
+        rows = np.arange(self.size, self.size + n)
+        self.size += n
+        return rows
+
+    def add(self, code):
+        # Missing fields of a Code raise AttributeError, the ones of a CodeView are None
+        def field(name):
+            value = getattr(code, name, None)
+            return -1 if value is None else value
+
+        values = (code.data.encode(), code.type, code.date, code.exam, field("page"), field("pdf_page"),
+                  field("question"), field("answer"), field("number"), code.x, code.y, code.w, code.h, code.marked)
+        row = self.reserve(1)[0]
+        self.array[row] = values
+        return row
+
+    def parse(self, data, x, y, w, h, page, pdf_page, marked):
+        # Same fields as Code.__init__ would get from each data, for all the codes at once
+        n = len(data)
+        rows = self.reserve(n)
+        table = self.array[rows[0]:rows[0] + n]
+        data = np.array(data, dtype="S16")
+        chars = data.view(np.uint8).reshape(n, 16)
+
+        # 11 digits after the letter, or 12 digits for the answers
+        letter = chars[:, 0] >= ord("A")
+        digits = chars[:, 1:13] - ord("0")
+        digits[~letter] = chars[~letter, 0:12] - ord("0")
+        if np.any(digits[:, :11] > 9) or np.any((digits[:, 11] > 9) & ~letter):
+            self.size -= n
+            raise ValueError("invalid code data")
+
+        def number(first, last):
+            return digits[:, first:last] @ 10 ** np.arange(last - first - 1, -1, -1)
+
+        table["type"] = self.TYPES[chars[:, 0]]
+        table["date"] = number(0, 6)
+        table["exam"] = number(6, 9)
+        table["x"], table["y"], table["w"], table["h"] = x, y, w, h
+        table["page"], table["pdf_page"], table["marked"] = page, pdf_page, marked
+        table["question"], table["answer"], table["number"] = -1, -1, -1
+
+        # Last two digits: question (O), page (P and Q) or number (N)
+        last = number(9, 11)
+        kind = table["type"]
+        table["question"] = np.where(kind == Code.TYPE_O, last, table["question"])
+        table["page"] = np.where((kind == Code.TYPE_P) | (kind == Code.TYPE_Q), last, table["page"])
+        table["number"] = np.where(kind == Code.TYPE_N, last, table["number"])
+
+        # Answers: question and answer (printed permuted, 5 to 8, stored as 1 to 4)
+        answers = ~letter
+        question, answer = last[answers], digits[answers, 11]
+        permuted = answer > 4
+        if np.any(question < 1) or np.any(question > len(Code.permut)):
+            self.size -= n
+            raise ValueError("invalid question in code data")
+        answer[permuted] = INVERSE[question[permuted] - 1, answer[permuted]]
+        if np.any(answer == 0):
+            self.size -= n
+            raise ValueError("invalid answer in code data")
+        table["question"][answers], table["answer"][answers] = question, answer
+        chars[np.flatnonzero(answers), 11] = answer + ord("0")
+        table["data"] = data
+        return rows
+
+
+class CodeView(Code):
+    """A row of a CodeTable seen as a Code, built when needed.
+
+    All the fields are read from (and written to) the columns, so the
+    Code methods (set_marked, set_pos, scale...) work on the table.
+    """
+
+    __slots__ = ("columns", "row")
+
+    def __init__(self, columns, row):  # noqa: the Code fields are the columns
+        self.columns = columns
+        self.row = row
+
+    def __eq__(self, other):
+        return isinstance(other, CodeView) and other.columns is self.columns and other.row == self.row
+
+    def __hash__(self):
+        return hash((id(self.columns), self.row))
+
+
+def column(name, missing=False):
+    # item() gives the Python value (int, float, bool) of the field
+    if missing:
+        def get(self):
+            value = self.columns.fields[name].item(self.row)
+            return None if value == -1 else value
+    else:
+        def get(self):
+            return self.columns.fields[name].item(self.row)
+
+    def set(self, value):
+        self.columns.fields[name][self.row] = -1 if missing and value is None else value
+
+    return property(get, set)
+
+
+for name in ("type", "date", "exam", "x", "y", "w", "h", "marked"):
+    setattr(CodeView, name, column(name))
+for name in ("page", "pdf_page", "question", "answer", "number"):
+    setattr(CodeView, name, column(name, True))
+CodeView.data = property(lambda self: self.columns.fields["data"].item(self.row).decode())
+CodeView.unique = property(lambda self: self.date * 1000 + self.exam)
+
+
+class CodeTable:
+    """Columnar alternative to CodeSet, with the same interface.
+
+    The fields of the codes are numpy columns (CodeColumns) instead of
+    one Python object per code, so a session of tens of thousands of codes
+    takes a few MB and loads in a single pass of the CSV parser. select()
+    and the get_* methods are vectorized, and a selection shares the
+    columns of its set: the codes it yields (CodeView) write through.
+    """
+
+    # Fields given by the data of a code, they never change: select() finds
+    # them by binary search in their sorted order (built on first use)
+    SORTED = ("type", "date", "exam", "question", "answer", "number")
+    SMALL = 256
+
+    def __init__(self, columns=None, rows=None):
+        self.columns = CodeColumns() if columns is None else columns
+        self.rows = np.zeros(0, dtype=np.int64) if rows is None else rows
+        self.positions = None
+        self.order = {}
+
+    def __add__(self, other):
+        c = CodeTable(self.columns)
+        c.extend(self)
+        c.extend(other)
+        return c
+
+    def lookup(self, key):
+        # Position in rows of the code with data key (bytes), None if not
+        # there. The dict is built the first time it is needed
+        if self.positions is None:
+            self.positions = {data: i for i, data in enumerate(self.columns.array["data"][self.rows].tolist())}
+        return self.positions.get(key)
+
+    def add_rows(self, rows):
+        # Same semantics as the dict of CodeSet: a code already there is replaced in place
+        if len(self.rows) == 0 and self.positions is None:
+            keys = self.columns.array["data"][rows].tolist()
+            if len(set(keys)) == len(keys):
+                self.rows = np.asarray(rows, dtype=np.int64)
+                return
+
+        new = []
+        for row, key in zip(rows.tolist(), self.columns.array["data"][rows].tolist()):
+            position = self.lookup(key)
+            if position is None:
+                self.positions[key] = len(self.rows) + len(new)
+                new.append(row)
+            elif position < len(self.rows):
+                self.rows[position] = row
+            else:
+                new[position - len(self.rows)] = row
+        self.rows = np.concatenate([self.rows, np.array(new, dtype=np.int64)])
+        self.order = {} if len(new) > 0 else self.order
+
+    def append(self, code):
+        same = isinstance(code, CodeView) and code.columns is self.columns
+        self.add_rows(np.array([code.row if same else self.columns.add(code)]))
+
+    def extend(self, codes):
+        if isinstance(codes, CodeTable) and codes.columns is self.columns:
+            self.add_rows(codes.rows)
+        else:
+            for code in codes:
+                self.append(code)
+
+    def clear(self):
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.positions = None
+        self.order = {}
+
+    def __repr__(self):
+        return "".join(str(code) + "\n" for code in self)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __next__(self):
+        return next(iter(self))
+
+    def __iter__(self):
+        return (CodeView(self.columns, row) for row in self.rows.tolist())
+
+    def remove(self, code):
+        position = self.lookup(code.data.encode())
+        if position is not None:
+            self.rows = np.delete(self.rows, position)
+            self.positions = None
+            self.order = {}
+
+    def values(self, name):
+        return self.columns.array[name][self.rows]
+
+    def sorted(self, key):
+        if key not in self.order:
+            values = self.values(key)
+            order = np.argsort(values, kind="stable")
+            self.order[key] = (order, values[order])
+        return self.order[key]
+
+    def select(self, **kwargs):
+        kwargs = {key: value.encode() if key == "data" else -1 if value is None else value for key, value in kwargs.items()}
+
+        # The narrowest range of the sorted fields (in the order of the
+        # set, the sort is stable), filtered by the rest of the fields.
+        # Small tables (an exam...) are just filtered, sorting costs more
+        rows = self.rows
+        for key, value in kwargs.items():
+            if key in self.SORTED and len(self.rows) > self.SMALL:
+                order, values = self.sorted(key)
+                first, last = np.searchsorted(values, value, "left"), np.searchsorted(values, value, "right")
+                if last - first < len(rows):
+                    rows = self.rows[order[first:last]]
+
+        mask = np.ones(len(rows), dtype=bool)
+        for key, value in kwargs.items():
+            mask &= self.columns.fields[key][rows] == value
+        return CodeTable(self.columns, rows[mask])
+
+    def get(self, code):
+        return self.get_code_by_data(code.data)
+
+    def get_code_by_data(self, data):
+        position = self.lookup(data.encode())
+        return None if position is None else CodeView(self.columns, int(self.rows[position]))
+
+    def get_exams(self):
+        return np.unique(self.values("exam")).tolist()
+
+    def get_questions(self):
+        return np.unique(self.values("question")[self.values("type") == Code.TYPE_A]).tolist()
+
+    def get_open(self):
+        return np.unique(self.values("question")[self.values("type") == Code.TYPE_O]).tolist()
+
+    def get_answers(self):
+        return np.unique(self.values("answer")[self.values("type") == Code.TYPE_A]).tolist()
+
+    def dumps(self):
+        # Same format as CodeSet.dumps (None for a missing page)
+        table = self.columns.array[self.rows]
+        pages = [None if page == -1 else page for page in table["page"].tolist()]
+        pdf_pages = [None if page == -1 else page for page in table["pdf_page"].tolist()]
+        return "".join("{},{:.2f},{:.2f},{:.2f},{:.2f},{},{},{:d}\n".format(data.decode(), x, y, w, h, page, pdf_page, marked)
+                       for data, x, y, w, h, page, pdf_page, marked in
+                       zip(table["data"].tolist(), table["x"].tolist(), table["y"].tolist(), table["w"].tolist(),
+                           table["h"].tolist(), pages, pdf_pages, table["marked"].astype(int).tolist()))
+
+    def read(self, source):
+        # source: a file name or a text buffer in the csv format
+        frame = pd.read_csv(source, header=None, names=range(8), dtype={0: str}, na_values=["None"])
+        if len(frame) == 0:
+            return
+        rows = self.columns.parse(frame[0].to_numpy(),
+                                  *(frame[i].to_numpy(dtype=np.float64) for i in range(1, 5)),
+                                  frame[5].fillna(-1).to_numpy(dtype=np.int64), frame[6].fillna(-1).to_numpy(dtype=np.int64),
+                                  frame[7].fillna(0).to_numpy(dtype=np.int64).astype(bool))
+        self.add_rows(rows)
+
+    def loads(self, text):
+        if text.strip():
+            self.read(io.StringIO(text))
+
+    def save(self, file_name):
+        with open(file_name, "w", encoding='utf-8') as f:
+            f.write(self.dumps())
+
+    def load(self, file_name):
+        try:
+            self.read(file_name)
+        except FileNotFoundError:
+            return False
+        except pd.errors.EmptyDataError:
+            pass
+        return True
+
+    def get_date(self):
+        return int(self.values("date")[0]) if len(self.rows) > 0 else None
+
+    def empty(self):
+        return len(self) == 0
+
+    def first(self, **kwargs) -> Code:
+        return next(iter(self.select(**kwargs)), None)
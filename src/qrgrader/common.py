@@ -1,11 +1,12 @@
 import os
 import sys
 
+import numpy as np
 import pandas
 from pandas import DataFrame
 
 from qrgrader.code import Code
-from qrgrader.code_set import CodeSet
+from qrgrader.code_set import CodeSet, PageCodeSet
 
 
 def get_workspace_paths(base):
@@ -102,9 +103,15 @@ class Questions:
 
 class Generated(CodeSet):
 
+    # Compact layout of the generated codes: one fixed-size row per code,
+    # rows sorted by (exam, page) so every page is a contiguous slice
+    TABLE_DTYPE = np.dtype([("data", "S16"), ("exam", "i4"), ("page", "i4"), ("pdf_page", "i4"),
+                            ("x", "i4"), ("y", "i4"), ("w", "i4"), ("h", "i4")])
+
     def __init__(self, ppm):
         super().__init__()
         self.ppm = ppm
+        self.table = None
 
     def load(self, filename):
         if not os.path.exists(filename):
@@ -116,8 +123,82 @@ class Generated(CodeSet):
                 x = int(int(x) / 65535 * 0.351459804 * self.ppm)
                 y = int(297 * self.ppm - int(int(y) / 65535 * 0.351459804 * self.ppm))  # 297???
                 self.append(Code(data, int(x), int(y), 120, 120, int(pag), int(pdf_pag)))
+
+        rows = [(c.data.encode(), c.exam, c.page, c.pdf_page, c.x, c.y, c.w, c.h) for c in self.codes.values()]
+        self.table = np.array(rows, dtype=self.TABLE_DTYPE)
+        self.table.sort(order=["exam", "page"], kind="stable")
         return True
 
+    def publish(self, filename):
+        # Write the table once so that the scan workers can memory-map
+        # it instead of receiving a pickled copy of every Code object
+        np.save(filename, self.table)
+        return GeneratedIndex(filename)
+
+
+class GeneratedIndex:
+    """Read-only view of a published Generated table.
+
+    Only the file name travels to the worker processes, the table itself
+    is memory-mapped on first use and shared by all of them through the
+    page cache. Codes are materialized only for the slice being looked up.
+
+    select_page() is a dict hit on the (exam, page) partition. get() is a
+    dict hit too: the rows of an exam by their data are indexed the first
+    time a code of that exam is looked up (a worker only sees a few exams).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.table = None
+        self.pages = {}
+        self.exams = {}
+        self.rows = {}
+
+    def __getstate__(self):
+        return {"filename": self.filename, "table": None, "pages": {}, "exams": {}, "rows": {}}
+
+    def open(self):
+        if self.table is not None:
+            return
+
+        self.table = np.load(self.filename, mmap_mode="r")
+
+        # Boundaries of each (exam, page) and exam partition
+        exam, page = np.asarray(self.table["exam"]), np.asarray(self.table["page"])
+        change = np.flatnonzero((exam[1:] != exam[:-1]) | (page[1:] != page[:-1])) + 1
+        starts, ends = np.r_[0, change], np.r_[change, len(self.table)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.pages[(int(exam[start]), int(page[start]))] = (start, end)
+            first, _ = self.exams.get(int(exam[start]), (start, end))
+            self.exams[int(exam[start])] = (first, end)
+
+    @staticmethod
+    def to_code(row):
+        return Code(row["data"].decode(), int(row["x"]), int(row["y"]), int(row["w"]), int(row["h"]),
+                    int(row["page"]), int(row["pdf_page"]))
+
+    def select_page(self, exam, page):
+        self.open()
+        start, end = self.pages.get((exam, page), (0, 0))
+        result = PageCodeSet()
+        for row in self.table[start:end]:
+            result.append(self.to_code(row))
+        return result
+
+    def get(self, code):
+        self.open()
+        rows = self.rows.get(code.exam)
+        if rows is None:
+            start, end = self.exams.get(code.exam, (0, 0))
+            rows = self.rows[code.exam] = {data: start + i for i, data in enumerate(self.table["data"][start:end].tolist())}
+        row = rows.get(code.data.encode())
+        return self.to_code(self.table[row]) if row is not None else None
+
+    def __len__(self):
+        self.open()
+        return len(self.table)
+
 
 class StudentsData:
     def __init__(self, filename):
@@ -2,6 +2,7 @@ import shutil
 import subprocess
 import sys
 import threading
+import time
 from multiprocessing import Process
 
 from pymupdf import pymupdf
@@ -32,8 +33,14 @@ class Generator(Process):
         self.verbose = kwargs.get("verbose", False)
         self.dir_source = kwargs.get("dir_source", "../..")
         self.semaphore = semaphore
+        self.trace = kwargs.get("trace", None)
+
+    def span(self, name, begin):
+        # Shared (manager) list of (exam, name, begin, end) for --trace
+        self.trace is not None and self.trace.append((self.uniqueid, name, begin, time.perf_counter()))
 
     def run(self):
+        begin = time.perf_counter()
         process = subprocess.Popen(['xelatex',
                                     '-interaction', 'nonstopmode',
                                     '-halt-on-error',
@@ -54,16 +61,21 @@ class Generator(Process):
             # Do something else
             return_code = process.poll()
             if return_code is not None:
+                self.span("xelatex", begin)
                 if return_code == 0:
                     this_one_done = True
                     if self.desired_pages != -1:
+                        check = time.perf_counter()
                         the_pdf = pymupdf.open(self.dir_temp_generator + str(self.uniqueid) + ".pdf")
                         if the_pdf.page_count != self.desired_pages:
                             this_one_done = False
                             print("Discarding exam {} ({} pages)".format(self.uniqueid, the_pdf.page_count))
+                        self.span("check pages", check)
 
                     if this_one_done:
+                        move = time.perf_counter()
                         shutil.move(self.dir_temp_generator + str(self.uniqueid) + ".pdf", self.dir_generated + str(self.uniqueid) + ".pdf")
+                        self.span("move", move)
 
                 else:
                     print(" * ERROR: Exam {} generation has finished with return code: {}".format(self.uniqueid, return_code))
@@ -72,4 +84,5 @@ class Generator(Process):
                     (self.verbose or return_code != 0) and print(output.strip())
 
                 break
+        self.span("exam", begin)
         self.semaphore.release()
@@ -0,0 +1,50 @@
+import json
+import os
+
+
+class Journal:
+    """Append-only record of the pages already scanned.
+
+    One line per page, written (and flushed) as soon as its result
+    arrives, so that an interrupted scan can be resumed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    def load(self):
+        # Returns {(filename, index): (codes, info)}, a line cut by a crash is ignored
+        pages = {}
+        if not os.path.exists(self.filename):
+            return pages
+
+        with open(self.filename, "r", encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                pages[(entry["file"], entry["page"])] = (entry["codes"], entry["info"])
+        return pages
+
+    def open(self, resume=False):
+        self.file = open(self.filename, "a" if resume else "w", encoding='utf-8')
+
+        # Do not glue new entries to a line cut by a crash
+        if self.file.tell() > 0:
+            with open(self.filename, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.file.write("\n")
+
+    def append(self, filename, index, codes, info):
+        self.file.write(json.dumps({"file": filename, "page": index, "codes": codes, "info": info}) + "\n")
+        self.file.flush()
+
+    def close(self, remove=False):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if remove and os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+
+
+class PageCache:
+    """Detection results of already scanned pages.
+
+    Each entry is a file named after the hash of the page content and of the
+    detection parameters, so a page is processed again only if it changed
+    or if it is processed differently. The directory is kept below max_size
+    bytes removing the least recently used entries first.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(page, params):
+        # Raw (still compressed) streams: no need to decode anything
+        doc = page.parent
+        h = hashlib.sha256(params.encode())
+        h.update(page.read_contents())
+        h.update("{}{}".format(page.rect, page.rotation).encode())
+        for image in page.get_images(full=True):
+            h.update(doc.xref_stream_raw(image[0]) or b"")
+        return h.hexdigest()
+
+    def get(self, key):
+        filename = self.directory + key + ".json"
+        try:
+            with open(filename, "r", encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Used now: it will be the last one to be evicted
+        os.utime(filename)
+        return entry["codes"], entry["info"]
+
+    def put(self, key, codes, info):
+        # Written aside and renamed, so that a reader never gets half an entry
+        filename = self.directory + key + ".json"
+        with open(filename + ".{}.tmp".format(os.getpid()), "w", encoding='utf-8') as f:
+            json.dump({"codes": codes, "info": info}, f)
+        os.replace(filename + ".{}.tmp".format(os.getpid()), filename)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            stat = os.stat(self.directory + name)
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(self.directory + name)
+            total -= size
@@ -1,116 +1,189 @@
-import argparse
-import math
+import json
 import os
-import sys
-import time
-from multiprocessing import Manager, Pool, Process
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process
 
 import cv2
 import numpy as np
 import pymupdf
 
 from qrgrader.code import Code
-from qrgrader.code_set import CodeSet, PageCodeSet
-from qrgrader.utils import pix2np, get_patches, threshold, get_codes, compute_similarity_transform, \
-    get_similarity_transform
+from qrgrader.code_set import PageCodeSet
+from qrgrader.stats import Stats
+from qrgrader.tuner import ThresholdTuner
+from qrgrader.utils import pix2np, get_patches, threshold, get_codes, get_similarity_transform, \
+    fit_similarity, file_hash
 
 
 class PageProcessor(Process):
 
-    def __init__(self, semaphore, filename, index, generated, result, **kwargs):
+    # Margins of the mark classifier beyond 4 sigmas: ink coverage (fraction
+    # of the box) and loss of texture (fraction of the texture of a code)
+    INK_MARGIN = 0.05
+    FLAT_MARGIN = 0.1
+
+    # Codes farther than this (mm) from the fitted page layout are misreads
+    ALIGN_TOLERANCE = 2.0
+
+    # Quick check of the page (pixels per mm of the preview): exam pages have
+    # dozens of code-sized dark squares (codes of 5 to 9 mm, the small and
+    # large options of the sty), pages with fewer are processed only if a P
+    # or Q code is decoded in a corner
+    PREVIEW_PPM = 2.0
+    MIN_SQUARES = 4
+    CODE_SIZES = (5.0, 9.0)
+
+    def __init__(self, jobs, results, generated, **kwargs):
         super().__init__()
-        self.filename = filename
-        self.index = index
+        self.jobs = jobs
+        self.results = results
         self.generated = generated
-        self.result = result
-        self.semaphore = semaphore
 
         self.dpi = kwargs.get("dpi", 400)
         self.thresholds = kwargs.get("thresholds", [50, 55, 60, 65, 70, 75, 80])
-        self.matrix = pymupdf.Matrix(self.dpi / 72, self.dpi / 72)
         self.show_patches = kwargs.get("show_patches", False)
         self.resize = kwargs.get("resize", 1.0)
         self.dir_images = kwargs.get("dir_images", "../..")
+        self.roi = kwargs.get("roi", False)
+        self.low_dpi = kwargs.get("low_dpi", 0)
+        self.extract_images = kwargs.get("extract_images", False)
+        self.cache = kwargs.get("cache", None)
+        self.decode = kwargs.get("decode", "patches")
+        self.classifier = kwargs.get("classifier", True)
+        self.quick_check = kwargs.get("quick_check", True)
+        self.decode_threads = kwargs.get("decode_threads", 1)
+        self.pool = None
+        self.watch = kwargs.get("watch", False)
+        self.stats = Stats(kwargs.get("stats", False), kwargs.get("trace", False))
+
+        # The settings that worked on the last pages are tried first, Otsu
+        # and adaptive binarization are candidates as well when tuning
+        tune = kwargs.get("tune", True)
+        self.tuner = ThresholdTuner(self.thresholds + (["otsu", "adaptive"] if tune else []),
+                                    kwargs.get("threshold_history"), tune)
+
+        # Decoder settings of the first attempts, the default
+        # (slower) ones are kept for the codes still missing
+        self.fast = dict(try_rotate=False, try_downscale=False)
 
         self.ppm = self.dpi / 25.4
 
     def run(self):
-
-        # Render the image
-        doc = pymupdf.open(self.filename)
+        # The worker lives for the whole scan: it pulls (filename, first, last)
+        # page ranges until it gets the None sentinel, so the imports, the
+        # generated codes and the rest of the state are loaded only once per
+        # process. The document stays open while consecutive ranges belong
+        # to the same file so its xref is parsed only once
+        doc = None
+
+        # In watch mode Ctrl+C is for the main process only (stop watching)
+        if self.watch:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # Few pages in flight: the patches (or regions) of a page are decoded
+        # in parallel, OpenCV and the decoder release the GIL
+        if self.decode_threads > 1:
+            self.pool = ThreadPoolExecutor(self.decode_threads, thread_name_prefix="decode")
+            self.stats.threaded()
+
+        # Everything that changes the result of a page is part of its cache key
+        if self.cache is not None:
+            params = json.dumps([self.dpi, self.tuner.candidates, self.roi, self.decode, self.classifier, self.quick_check, self.low_dpi, self.extract_images,
+                                 self.resize, file_hash(self.generated.filename)])
+
+        for filename, first, last in iter(self.jobs.get, None):
+            if doc is None or doc.name != filename:
+                doc is not None and doc.close()
+                doc = pymupdf.open(filename)
+
+            for index in range(first, last):
+                try:
+                    with self.stats.stage("page"):
+                        with self.stats.stage("cache"):
+                            key = self.cache.key(doc[index], params) if self.cache is not None else None
+                            cached = self.cache.get(key) if key is not None else None
+
+                        # A cached page is good only if its image is still there
+                        if cached is not None and os.path.exists(self.dir_images + os.sep + cached[1].get("image", "")):
+                            record, self.info = cached
+                            self.info["cached"] = True
+                        else:
+                            record = self.process(doc, index).dumps()
+                            key is not None and self.cache.put(key, record, self.info)
+                except Exception as e:
+                    print(f"\nERROR: processing {os.path.basename(filename)} page {index}: {e}")
+                    record, self.info = "", {"error": True}
+                # One serialized record per page, merged by the main process
+                # (with the stage times of the page if --stats is enabled)
+                self.results.put((filename, index, record, self.info, self.stats.take()))
+
+        doc is not None and doc.close()
+        self.pool is not None and self.pool.shutdown()
+
+    def process(self, doc, index):
+        self.filename = doc.name
+        self.index = index
+        self.info = {}
         page = doc[self.index]
-        image = pix2np(page.get_pixmap(matrix=self.matrix))  # noqa
-        doc.close()
-
-
-        # Find page, orientation and rotate page
-        rotation = None
-        detected = PageCodeSet()
-        h, w = image.shape[:2]
-
-        for th in self.thresholds:
-
-            ne = threshold(image[0:500, w - 500:w], th)
-            for text, cx, cy, cw, ch in get_codes(ne):
-                if text.startswith("P"):
-                    rotation = -1
-                elif text.startswith("Q"):
-                    rotation = cv2.ROTATE_180
-                detected.append(Code(text, cx, cy, cw, ch))
-
-            if rotation is None:
-                nw = threshold(image[0:500, 0:500], th)
-                for text, cx, cy, cw, ch in get_codes(nw):
-                    if text.startswith("P"):
-                        rotation = cv2.ROTATE_90_CLOCKWISE
-                    elif text.startswith("Q"):
-                        rotation = cv2.ROTATE_90_COUNTERCLOCKWISE
-                    detected.append(Code(text, cx, cy, cw, ch))
-
-            if rotation is None:
-                sw = threshold(image[h - 500:h, 0:500], th)
-                for text, cx, cy, cw, ch in get_codes(sw):
-                    if text.startswith("P"):
-                        rotation = cv2.ROTATE_180
-                    elif text.startswith("Q"):
-                        rotation = -1
-                    detected.append(Code(text, cx, cy, cw, ch))
 
-            if rotation is None:
-                se = threshold(image[h - 500:h, w - 500:w], th)
-                for text, cx, cy, cw, ch in get_codes(se):
-                    if text.startswith("P"):
-                        rotation = cv2.ROTATE_90_COUNTERCLOCKWISE
-                    elif text.startswith("Q"):
-                        rotation = cv2.ROTATE_90_CLOCKWISE
-                    detected.append(Code(text, cx, cy, cw, ch))
-
-            if rotation is not None:
-                break
-
-        if rotation is not None and rotation != -1:
-            image = cv2.rotate(image, rotation)
-
-        # Get the page number if we got it
-        page = detected.get_page()
-
-        # Clear the detected because the
-        # page may have been rotated
-        detected.clear()
-
-        # Process the page and extract the detected
-        for th in self.thresholds:
-            th_image = threshold(image, th)
-            patches = get_patches(th_image, self.ppm, 8)
-
-            for px, py, pw, ph in patches:
-                patch = image[py:py + ph, px:px + pw]
-
-                if self.show_patches:
-                    cv2.rectangle(image, (px, py), (px + pw, py + ph), (0, 0, 255), 1)
-
-                for text, cx, cy, cw, ch in get_codes(patch):
-                    detected.append(Code(text, px + cx, py + cy, cw, ch, page, self.index))
+        # Scanned pages are usually just one image, if so (and asked to) we use it as it
+        # is; off by default, at the scan resolution some light marks are missed
+        with self.stats.stage("extract"):
+            embedded = self.extract(page) if self.extract_images else None
+        self.info["embedded"] = embedded is not None
+
+        # Back sides, cover sheets and other pages without codes end here,
+        # unless a P or Q code is decoded in a corner (blank pages have none).
+        # A page rendered for that check is the first one the pipeline uses
+        rendered = None
+        if self.quick_check:
+            with self.stats.stage("preview"):
+                skipped = self.check_page(page, embedded)
+            if skipped == "no codes":
+                if embedded is None:
+                    rendered = self.render(page, self.low_dpi or self.dpi)
+                with self.stats.stage("corners"):
+                    skipped = None if self.has_corner_codes(*(rendered or embedded)[:2]) else skipped
+            if skipped is not None:
+                self.info["skipped"] = skipped
+                self.stats.count("skipped " + skipped)
+                return PageCodeSet()
+
+        # Adaptive resolution: first try at low dpi, the page is processed
+        # again at full dpi only if the result can not be explained by marks
+        low_ppm = self.low_dpi / 25.4
+        low = self.low_dpi and (embedded is None or embedded[1] > low_ppm)
+
+        escalated = False
+        if low:
+            if embedded is None:
+                image, ppm = rendered or self.render(page, self.low_dpi)
+            else:
+                with self.stats.stage("resize"):
+                    image, ppm = cv2.resize(embedded[0], None, fx=low_ppm / embedded[1], fy=low_ppm / embedded[1],
+                                            interpolation=cv2.INTER_AREA), low_ppm
+            image, detected, page_number, expected = self.detect(image, ppm)
+            escalated = len(expected) == 0 or not self.is_plausible(expected, detected)
+            self.info["escalated"] = escalated
+            self.stats.count("escalated", escalated)
+
+        if not low or escalated:
+            if embedded is not None:
+                image, ppm = embedded[:2]
+            else:
+                image, ppm = rendered if rendered is not None and not low else self.render(page, self.dpi)
+            image, detected, page_number, expected = self.detect(image, ppm)
+
+        # From now on the positions are in pixels at self.dpi, as the generated
+        # ones, and relative to the page even if the scanned image is not
+        dx, dy = (0, 0) if embedded is None else (v * self.dpi / 72 for v in embedded[2])
+        for code in detected:
+            code.scale(self.ppm / ppm)
+            code.set_pos((code.x + dx, code.y + dy))
+
+        page = page_number
+        resize = self.resize * self.ppm / ppm
 
         # Try again with the whole page
         page = detected.get_page() if page is None else page
@@ -123,46 +196,27 @@ class PageProcessor(Process):
                 for code in detected:
                     code.set_page(page)
 
-        if self.resize != 1.0:
-            image = cv2.resize(image, (int(image.shape[1] * self.resize), int(image.shape[0] * self.resize)),
-                               interpolation=cv2.INTER_AREA)
+        if resize != 1.0:
+            with self.stats.stage("resize"):
+                image = cv2.resize(image, (int(image.shape[1] * resize), int(image.shape[0] * resize)),
+                                   interpolation=cv2.INTER_AREA)
 
         if page is not None:
-            cv2.imwrite(self.dir_images + os.sep + "page-{}-{}-{:03d}.jpg".format(detected.get_date(), detected.get_exam_id(), page), image)
+            self.info["image"] = "page-{}-{}-{:03d}.jpg".format(detected.get_date(), detected.get_exam_id(), page)
         elif detected.get_exam_id():
-            cv2.imwrite(self.dir_images + os.sep + "page-{}-{}-{:03d}.jpg".format(detected.get_date(), detected.get_exam_id(), 0), image)
+            self.info["image"] = "page-{}-{}-{:03d}.jpg".format(detected.get_date(), detected.get_exam_id(), 0)
         else:
-            cv2.imwrite(self.dir_images + os.sep + "{}-{:03d}.jpg".format(self.filename, self.index), image)
+            self.info["image"] = "{}-{:03d}.jpg".format(self.filename, self.index)
+        with self.stats.stage("imwrite"):
+            cv2.imwrite(self.dir_images + os.sep + self.info["image"], image)
 
         # # Compute the transformation
-        generated_page_codeset = PageCodeSet(self.generated.select(exam=exam, page=page))
-
-        # We will use the two codes that are the farthest apart to compute
-        # the transformation, if we have at least two codes detected
-        max_dist, codes = 0, None
-        for code1 in detected:
-            for code2 in detected:
-                if code1!=code2:
-                    dist = math.sqrt((code1.get_pos()[0] - code2.get_pos()[0]) ** 2 + (code1.get_pos()[1] - code2.get_pos()[1]) ** 2)
-                    if dist > max_dist:
-                        max_dist = dist
-                        codes = (code1, code2)
-
-        if codes is not None:
-            # we have at least two codes detected, we can use them to compute the transformation
-            code1, code2 = codes[0], codes[1]
-            p11 = self.generated.get(code1).get_pos()
-            p12 = self.generated.get(code2).get_pos()
-            p21 = code1.get_pos()
-            p22 = code2.get_pos()
-            transform = get_similarity_transform([p11, p12], [p21, p22]) # noqa
-        elif len(detected) > 0:
-            # we have detected just one code, we can use it to compute the transformation
-            code1 = detected.first()
-            p11 = self.generated.get(code1).get_pos()
-            p21 = code1.get_pos()
-            transform = lambda pt: (pt[0] + (p21[0] - p11[0]), pt[1] + (p21[1] - p11[1]))
-        else:
+        generated_page_codeset = self.generated.select_page(exam, page)
+
+        with self.stats.stage("transform"):
+            transform, residual = self.get_transform(detected, self.generated, self.ppm)
+        self.info["residual"] = residual
+        if transform is None:
             # No codes detected, we can not compute the transformation, we will just use the identity
             transform = lambda pt: pt
 
@@ -178,7 +232,427 @@ class PageProcessor(Process):
             code.set_size(120, 120)
             code.scale(72.0 / self.dpi)
             code.set_marked(detected.get(code) is None)
-            self.result.append(code)
+
+        # Settings that worked in this page, for the histogram of the session
+        self.info["thresholds"] = self.tuner.take()
 
         #print(f"Processed {os.path.basename(self.filename)} page {self.index} ({len(generated_page_codeset)} codes detected)")
-        self.semaphore.release()
+        return generated_page_codeset
+
+    def render(self, page, dpi):
+        # The whole pipeline works on a single channel
+        with self.stats.stage("render"):
+            pix = page.get_pixmap(matrix=pymupdf.Matrix(dpi / 72, dpi / 72), colorspace=pymupdf.csGRAY)  # noqa
+        with self.stats.stage("pix2np"):
+            image = pix2np(pix)
+        if self.show_patches:
+            image = image.copy()  # the rendered buffer is read-only
+        return image, dpi / 25.4
+
+    def extract(self, page):
+        # Returns the image, its ppm and its origin in the page (points) if
+        # the page is just one image covering it all, as copiers produce, else None
+        images = page.get_images(full=True)
+        if len(images) != 1 or page.rotation != 0:
+            return None
+
+        # Nothing else drawn in the page (get_image_info without
+        # xrefs, otherwise the image would be decoded to hash it)
+        placements = page.get_image_info()
+        if [kind for kind, _ in page.get_bboxlog()] != ["fill-image"] or len(placements) != 1:
+            return None
+
+        xref, smask, width, height, bpc = images[0][:5]
+        if smask != 0 or bpc == 1 and images[0][5] == "":
+            return None
+
+        # Placed upright, not mirrored and covering (almost) the whole page
+        rect, (a, b, c, d, _, _) = pymupdf.Rect(placements[0]["bbox"]), placements[0]["transform"]
+        if b != 0 or c != 0 or a <= 0 or d <= 0 or abs(rect & page.rect) < 0.98 * abs(page.rect):
+            return None
+
+        info = page.parent.extract_image(xref)
+        if info is None or info.get("colorspace") not in (1, 3):
+            return None
+
+        image = cv2.imdecode(np.frombuffer(info["image"], dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None or image.shape[1] != width or image.shape[0] != height:
+            return None
+
+        return image, width / (rect.width * 25.4 / 72), (rect.x0, rect.y0)
+
+    def detect(self, image, ppm):
+        # Find the codes in the image (ppm pixels per mm), positions are in image pixels.
+        # Returns the upright image, the codes, the page number and the expected codes
+
+        # Find page, orientation and rotate page
+        rotation = None
+        detected = PageCodeSet()
+        h, w = image.shape[:2]
+
+        # Corners of 31.75 mm (500 pixels at 400 dpi)
+        c = int(31.75 * ppm)
+
+        with self.stats.stage("orientation"):
+            for th in self.tuner.order("corners"):
+
+                ne = self.threshold(image[0:c, w - c:w], th)
+                for text, cx, cy, cw, ch in self.get_codes(ne):
+                    if text.startswith("P"):
+                        rotation = -1
+                    elif text.startswith("Q"):
+                        rotation = cv2.ROTATE_180
+                    detected.append(Code(text, cx, cy, cw, ch))
+
+                if rotation is None:
+                    nw = self.threshold(image[0:c, 0:c], th)
+                    for text, cx, cy, cw, ch in self.get_codes(nw):
+                        if text.startswith("P"):
+                            rotation = cv2.ROTATE_90_CLOCKWISE
+                        elif text.startswith("Q"):
+                            rotation = cv2.ROTATE_90_COUNTERCLOCKWISE
+                        detected.append(Code(text, cx, cy, cw, ch))
+
+                if rotation is None:
+                    sw = self.threshold(image[h - c:h, 0:c], th)
+                    for text, cx, cy, cw, ch in self.get_codes(sw):
+                        if text.startswith("P"):
+                            rotation = cv2.ROTATE_180
+                        elif text.startswith("Q"):
+                            rotation = -1
+                        detected.append(Code(text, cx, cy, cw, ch))
+
+                if rotation is None:
+                    se = self.threshold(image[h - c:h, w - c:w], th)
+                    for text, cx, cy, cw, ch in self.get_codes(se):
+                        if text.startswith("P"):
+                            rotation = cv2.ROTATE_90_COUNTERCLOCKWISE
+                        elif text.startswith("Q"):
+                            rotation = cv2.ROTATE_90_CLOCKWISE
+                        detected.append(Code(text, cx, cy, cw, ch))
+
+                if rotation is not None:
+                    self.tuner.success("corners", th)
+                    break
+
+        if rotation is not None and rotation != -1:
+            image = cv2.rotate(image, rotation)
+
+        # Get the page number if we got it
+        page = detected.get_page()
+        exam = detected.get_exam_id()
+
+        # Clear the detected because the
+        # page may have been rotated
+        detected.clear()
+
+        # Codes that should be in this page (if we know which one it is) at this resolution
+        expected = self.generated.select_page(exam, page) if page is not None else PageCodeSet()
+        for code in expected:
+            code.scale(ppm / self.ppm)
+
+        # If the page is known, decode only around the expected positions
+        if self.roi and len(expected) > 0:
+            with self.stats.stage("roi"):
+                detected = self.detect_roi(image, ppm, expected, page) or detected
+
+        # Whole-page mode: one decoder call per page (or per tile) finds most of
+        # the codes, the per-patch search is left for the regions where codes are
+        # missing. If the page can not be aligned we start again with the patches
+        if self.decode != "patches" and len(expected) > 0 and len(detected) == 0:
+            with self.stats.stage("whole"):
+                tiles = self.get_tiles(image, ppm)
+                for (x0, y0, _), codes in zip(tiles, self.map(lambda tile: self.get_codes(tile[2], **self.fast), tiles)):
+                    for text, cx, cy, cw, ch in codes:
+                        detected.append(Code(text, x0 + cx, y0 + cy, cw, ch, page, self.index))
+
+            unresolved = [code for code in expected if detected.get(code) is None]
+            if len(expected) - len(unresolved) < 2:
+                detected.clear()
+            elif len(unresolved) > 0:
+                size = int(np.median([max(code.get_size()) for code in detected]))
+                with self.stats.stage("regions"):
+                    self.decode_regions(image, ppm, unresolved, self.get_transform(detected, expected, ppm)[0], size, detected,
+                                        page, self.region_order())
+
+        # Process the page and extract the detected
+        # (also fallback for pages that could not be aligned)
+        order = self.tuner.order("page")
+        for i, th in enumerate(order if len(detected) == 0 else []):
+            th_image = self.threshold(image, th)
+            patches = self.get_patches(th_image, ppm)
+
+            decoded = self.map(lambda patch: self.get_codes(image[patch[1]:patch[1] + patch[3], patch[0]:patch[0] + patch[2]],
+                                                            **self.fast), patches)
+            for (px, py, pw, ph), codes in zip(patches, decoded):
+                for text, cx, cy, cw, ch in codes:
+                    detected.append(Code(text, px + cx, py + cy, cw, ch, page, self.index))
+
+            if self.show_patches:
+                for px, py, pw, ph in patches:
+                    cv2.rectangle(image, (px, py), (px + pw, py + ph), 0, 1)
+
+            # Threshold cascade: done if all the expected codes are there, otherwise,
+            # once aligned, the next thresholds are tried only where codes are missing
+            if len(expected) > 0:
+                unresolved = [code for code in expected if detected.get(code) is None]
+                if len(unresolved) == 0:
+                    self.tuner.success("page", th)
+                    break
+                if len(expected) - len(unresolved) >= 2:
+                    self.tuner.success("page", th)
+                    remaining = [other for other in self.region_order() if other not in order[:i + 1]]
+                    size = int(np.median([max(code.get_size()) for code in detected]))
+                    transform, _ = self.get_transform(detected, expected, ppm)
+                    with self.stats.stage("regions"):
+                        self.decode_regions(image, ppm, unresolved, transform, size, detected, page, remaining)
+                    break
+
+        return image, detected, page, expected
+
+    def map(self, fn, items):
+        # fn over items, in order, on the thread pool if there is one. Without
+        # it the map is lazy: each item is done when the previous result is used
+        return map(fn, items) if self.pool is None else self.pool.map(fn, items)
+
+    def threshold(self, image, th):
+        self.stats.count("thresholds")
+        with self.stats.stage("threshold"):
+            return threshold(image, th)
+
+    def get_patches(self, image, ppm):
+        with self.stats.stage("patches"):
+            patches = get_patches(image, ppm, 8)
+        self.stats.count("patches", len(patches))
+        return patches
+
+    def get_codes(self, image, **kwargs):
+        with self.stats.stage("decode"):
+            codes = get_codes(image, **kwargs)
+        self.stats.count("decode attempts")
+        self.stats.count("decode hits", len(codes))
+        return codes
+
+    def check_page(self, page, embedded):
+        # "blank", "no codes" or None (maybe an exam page) from a tiny gray
+        # preview: the codes, blurred, are dark squares on the paper
+        if embedded is not None:
+            f = self.PREVIEW_PPM / embedded[1]
+            preview = cv2.resize(embedded[0], None, fx=f, fy=f, interpolation=cv2.INTER_LINEAR)
+        else:
+            pix = page.get_pixmap(matrix=pymupdf.Matrix(self.PREVIEW_PPM * 25.4 / 72, self.PREVIEW_PPM * 25.4 / 72),
+                                  colorspace=pymupdf.csGRAY)  # noqa
+            preview = pix2np(pix)
+
+        # Levels of the paper and of the ink, whatever the contrast of the scan
+        paper, ink = np.percentile(preview, (90, 0.5))
+        mask = (preview < paper - (paper - ink) / 4).astype(np.uint8)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
+        _, _, boxes, _ = cv2.connectedComponentsWithStats(mask)
+        w, h, area = boxes[1:, 2], boxes[1:, 3], boxes[1:, 4]
+        low, high = self.CODE_SIZES[0] * self.PREVIEW_PPM * 0.7, self.CODE_SIZES[1] * self.PREVIEW_PPM * 1.3
+        squares = (w > low) & (w < high) & (h > low) & (h < high) & (area > 0.6 * w * h)
+        if squares.sum() >= self.MIN_SQUARES:
+            return None
+        return "blank" if (preview < paper - 40).mean() < 0.0005 else "no codes"
+
+    def has_corner_codes(self, image, ppm):
+        # True if a P or Q code is decoded in a corner of the page image (as
+        # in detect, whatever the orientation): such a page is never skipped
+        h, w = image.shape[:2]
+        c = int(31.75 * ppm)
+        corners = [image[0:c, w - c:w], image[0:c, 0:c], image[h - c:h, 0:c], image[h - c:h, w - c:w]]
+        for th in self.tuner.order("corners"):
+            for corner in corners:
+                if any(text.startswith(("P", "Q")) for text, _, _, _, _ in self.get_codes(self.threshold(corner, th))):
+                    return True
+        return False
+
+    @staticmethod
+    def is_plausible(expected, detected):
+        # Codes not decoded are taken as marked: this is credible if P, Q and the
+        # open questions codes are there and there is at most one mark per
+        # question and per NIA figure. Otherwise the page deserves another try
+        marks = {}
+        for code in expected:
+            if detected.get(code) is not None:
+                continue
+            if code.type in (Code.TYPE_P, Code.TYPE_Q, Code.TYPE_O):
+                return False
+            key = (code.type, code.question if code.type == Code.TYPE_A else code.number // 10)
+            marks[key] = marks.get(key, 0) + 1
+            if marks[key] > 1:
+                return False
+        return True
+
+    def get_corners(self, image, ppm):
+        # Once the page is upright, P is in the top-right corner and Q in the bottom-left one
+        h, w = image.shape[:2]
+        size = int(47.6 * ppm)
+        corners = PageCodeSet()
+        for th in self.tuner.order("corners"):
+            for x, y in ((max(w - size, 0), 0), (0, max(h - size, 0))):
+                for text, cx, cy, cw, ch in self.get_codes(self.threshold(image[y:y + size, x:x + size], th)):
+                    corners.append(Code(text, x + cx, y + cy, cw, ch, None, self.index))
+            if corners.get_p() is not None and corners.get_q() is not None:
+                self.tuner.success("corners", th)
+                break
+        return corners
+
+    def get_transform(self, detected, reference, ppm):
+        # Transformation from the generated positions (taken from reference) to
+        # the page ones (ppm pixels per mm) and its residual in mm, (None, None)
+        # if no detected code is in reference
+        matched = [(reference.get(code).get_pos(), code.get_pos()) for code in detected if reference.get(code) is not None]
+
+        if len(matched) > 1:
+            # Fitted to all the codes, a misread one (more than
+            # ALIGN_TOLERANCE mm away from the others) is left out
+            p1, p2 = zip(*matched)
+            transform, residual, _ = fit_similarity(p1, p2, self.ALIGN_TOLERANCE * ppm)
+            return transform, residual / ppm
+        elif len(matched) > 0:
+            # we have detected just one code, we can use it to compute the transformation
+            p11, p21 = matched[0]
+            return lambda pt: (pt[0] + (p21[0] - p11[0]), pt[1] + (p21[1] - p11[1])), 0.0
+        return None, None
+
+    def detect_roi(self, image, ppm, expected, page):
+        # Align the expected layout with the P and Q codes and decode only a small
+        # region around each expected code. Returns None if the page can not be aligned
+        corners = self.get_corners(image, ppm)
+        anchors = [code for code in (corners.get_p(), corners.get_q()) if code is not None and expected.get(code) is not None]
+
+        # A single anchor gives no rotation nor scale, not enough to trust small regions
+        if len(anchors) < 2:
+            return None
+
+        transform = get_similarity_transform([expected.get(code).get_pos() for code in anchors],
+                                             [code.get_pos() for code in anchors])
+
+        detected = PageCodeSet()
+        detected.extend(anchors)
+
+        # The regions are one code wide around the expected top-left corner
+        size = int(max(max(code.get_size()) for code in anchors))
+        self.decode_regions(image, ppm, expected, transform, size, detected, page, self.region_order())
+        return detected
+
+    def get_tiles(self, image, ppm):
+        # The whole image, or 2x3 tiles overlapping more than a code so
+        # that every code is complete in at least one of them
+        if self.decode == "page":
+            return [(0, 0, image)]
+
+        h, w = image.shape[:2]
+        overlap = int(12 * ppm)
+        tiles = []
+        for row in range(3):
+            for col in range(2):
+                x0, y0 = max(col * w // 2 - overlap, 0), max(row * h // 3 - overlap, 0)
+                x1, y1 = min((col + 1) * w // 2 + overlap, w), min((row + 1) * h // 3 + overlap, h)
+                tiles.append((x0, y0, image[y0:y1, x0:x1]))
+        return tiles
+
+    def region_order(self):
+        # Whole-image settings (Otsu, adaptive) make little sense in a small
+        # region and would be paid by every marked code, they are left out
+        return [th for th in self.tuner.order("regions") if th in self.thresholds]
+
+    def decode_regions(self, image, ppm, codes, transform, size, detected, page, thresholds):
+        # Decode the region around the expected position of each code
+        # that is not yet in detected, trying thresholds only if needed
+        margin = size // 2
+        h, w = image.shape[:2]
+
+        regions = []
+        for code in codes:
+            x, y = transform(code.get_pos())
+            x0, y0 = min(max(int(x) - margin, 0), w), min(max(int(y) - margin, 0), h)
+            x1, y1 = min(max(int(x) + size + margin, 0), w), min(max(int(y) + size + margin, 0), h)
+            regions.append((code, x0, y0, image[y0:y1, x0:x1]))
+
+        # A code may have been decoded already in the region of a neighbour
+        # (only known in time if the regions are not decoded in parallel)
+        def raw(region):
+            return [] if detected.get(region[0]) is not None else self.get_codes(region[3], **self.fast)
+
+        for (code, x0, y0, roi), found in zip(regions, self.map(raw, regions)):
+            for text, cx, cy, cw, ch in found:
+                detected.append(Code(text, x0 + cx, y0 + cy, cw, ch, page, self.index))
+
+        # The boxes that are clearly marked would only fail slowly, they are not decoded
+        missing = [code for code, _, _, _ in regions if detected.get(code) is None]
+        marked = self.classify(image, missing, transform, size, detected) if self.classifier else set()
+
+        def cascade(region):
+            code, _, _, roi = region
+            if detected.get(code) is not None or code.data in marked:
+                return [], None
+            return self.decode_region(code, roi, ppm, thresholds)
+
+        for (code, x0, y0, roi), (found, th) in zip(regions, self.map(cascade, regions)):
+            for text, cx, cy, cw, ch in found:
+                detected.append(Code(text, x0 + cx, y0 + cy, cw, ch, page, self.index))
+            th is not None and self.tuner.success("regions", th)
+
+    def decode_region(self, code, roi, ppm, thresholds):
+        # Codes found in the region of a code not found in the raw region (same
+        # contour search used for the whole page), and the threshold that found it
+        found, patches = [], set()
+        for th in thresholds:
+            for px, py, pw, ph in self.get_patches(self.threshold(roi, th), ppm):
+                px, py = max(px, 0), max(py, 0)
+                patches.add((px, py, pw, ph))
+                for text, cx, cy, cw, ch in self.get_codes(roi[py:py + ph, px:px + pw], **self.fast):
+                    found.append((text, px + cx, py + cy, cw, ch))
+            if any(text == code.data for text, _, _, _, _ in found):
+                return found, th
+
+        # Last attempt with all the decoder options, on the same patches only:
+        # the whole region would decode codes under a light mark
+        for px, py, pw, ph in sorted(patches):
+            for text, cx, cy, cw, ch in self.get_codes(roi[py:py + ph, px:px + pw]):
+                found.append((text, px + cx, py + cy, cw, ch))
+        return found, None
+
+    def classify(self, image, codes, transform, size, detected):
+        # Ink coverage and texture of the boxes of the codes not decoded, compared
+        # with those of the codes decoded in the same page: a box much darker, or
+        # much flatter (covered by a uniform mark), is marked. Anything closer to
+        # a code (a thin stroke looks much like code texture) is left to the decoder
+        references = list(detected)
+        inset = size // 8
+        side = size - 2 * inset
+        if len(codes) == 0 or len(references) < 6 or side < 8:
+            return set()
+
+        with self.stats.stage("classify"):
+            h, w = image.shape[:2]
+            corners = np.array([code.get_pos() for code in references] + [transform(code.get_pos()) for code in codes])
+            xs = np.clip(corners[:, 0].astype(int) + inset, 0, w - side)
+            ys = np.clip(corners[:, 1].astype(int) + inset, 0, h - side)
+            boxes = np.lib.stride_tricks.sliding_window_view(image, (side, side))[ys, xs].astype(np.int16)
+
+            # Ink: below the middle of the paper and ink levels of the decoded codes
+            n = len(references)
+            low, high = np.percentile(boxes[:n], (5, 95))
+            dark = (boxes < (low + high) / 2).mean(axis=(1, 2))
+
+            # Texture relative to the contrast of the box itself, so that a faint
+            # code is not taken as a covered one (too faint boxes are left alone)
+            p5, p95 = np.percentile(boxes.reshape(len(boxes), -1), (5, 95), axis=1)
+            local = p95 - p5
+            edges = (np.abs(np.diff(boxes, axis=1)).mean(axis=(1, 2)) + np.abs(np.diff(boxes, axis=2)).mean(axis=(1, 2))) / np.maximum(local, 1)
+
+            dark_mean, dark_std = dark[:n].mean(), dark[:n].std()
+            edges_mean, edges_std = edges[:n].mean(), edges[:n].std()
+            # Much more ink, or much less (a light mark over the code), or much less texture
+            contrasted = local[n:] > 0.3 * (high - low)
+            inked = dark[n:] > dark_mean + 4 * dark_std + self.INK_MARGIN
+            faded = (dark[n:] < dark_mean - 4 * dark_std - self.INK_MARGIN) & contrasted
+            covered = (edges[n:] < edges_mean - 4 * edges_std - self.FLAT_MARGIN * edges_mean) & contrasted
+
+        marked = {code.data for code, is_marked in zip(codes, inked | faded | covered) if is_marked}
+        self.stats.count("classified marked", len(marked))
+        return marked
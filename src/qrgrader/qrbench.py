@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+import pymupdf
+
+from qrgrader.code import Code
+from qrgrader.code_set import CodeSet
+from qrgrader.common import check_workspace, get_workspace_paths, get_date, Generated
+from qrgrader.utils import makedir
+
+
+def mark(page, code, rng, darkness):
+    # Pen mark on the answer box: an oval of random size, position and darkness
+    x, y = code.x + 10 + rng.uniform(-1.5, 1.5), code.y - 2 + rng.uniform(-1.5, 1.5)
+    rx, ry = rng.uniform(3.5, 6), rng.uniform(3.5, 6)
+    gray = 1 - rng.uniform(*darkness)
+    page.draw_oval(pymupdf.Rect(x - rx, y - ry, x + rx, y + ry), color=None, fill=(gray, gray, gray))
+
+
+def distort(image, rng, args):
+    # Copier-like distortions of a grayscale page image
+    h, w = image.shape
+    angle = rng.uniform(-args.get("skew"), args.get("skew"))
+    scale = 1 + rng.uniform(-args.get("scale"), args.get("scale"))
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, scale)
+    matrix[:, 2] += rng.uniform(-0.01, 0.01, 2) * (w, h)
+    image = cv2.warpAffine(image, matrix, (w, h), borderValue=255)
+
+    if (sigma := rng.uniform(0, args.get("blur"))) > 0.1:
+        image = cv2.GaussianBlur(image, (0, 0), sigma)
+
+    if args.get("noise") > 0:
+        image = np.clip(image + rng.normal(0, args.get("noise"), image.shape), 0, 255).astype(np.uint8)
+
+    # Pages fed upside down or sideways
+    if rng.uniform() < args.get("rotate"):
+        image = cv2.rotate(image, [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE][rng.integers(3)])
+
+    return image
+
+
+def create_corpus(pdf_filenames, generated, dir_scanned, rng, args):
+    # Returns the data of the codes that have been marked (ground truth)
+    truth = []
+    for pdf_filename in pdf_filenames:
+        print("   Creating {}".format(os.path.basename(pdf_filename)), end="\r")
+        doc = pymupdf.open(pdf_filename)
+        new_pdf = pymupdf.open()
+        exam = int(os.path.basename(pdf_filename)[6:9])
+
+        for page in doc:
+            codes = generated.select(exam=exam, page=page.number + 1)
+
+            # One answer per question (some left blank) and one number per NIA figure
+            marks = []
+            type_a = codes.select(type=Code.TYPE_A)
+            for question in type_a.get_questions():
+                answers = list(type_a.select(question=question))
+                if rng.uniform() >= args.get("blank"):
+                    marks.append(answers[rng.integers(len(answers))])
+
+            type_n = codes.select(type=Code.TYPE_N)
+            for figure in sorted({code.number // 10 for code in type_n}):
+                numbers = [code for code in type_n if code.number // 10 == figure]
+                marks.append(numbers[rng.integers(len(numbers))])
+
+            for code in marks:
+                mark(page, code, rng, args.get("darkness"))
+            truth.extend(marks)
+
+            # The page as the copier would see it, one image per page
+            pix = page.get_pixmap(matrix=pymupdf.Matrix(args.get("dpi") / 72, args.get("dpi") / 72), colorspace=pymupdf.csGRAY)
+            image = distort(np.frombuffer(pix.samples, np.uint8).reshape(pix.h, pix.w), rng, args)
+            data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, args.get("quality")])[1].tobytes()
+            h, w = image.shape
+            new_page = new_pdf.new_page(width=page.rect.width if h > w else page.rect.height,
+                                        height=page.rect.height if h > w else page.rect.width)
+            new_page.insert_image(new_page.rect, stream=data)
+            del pix
+
+        new_pdf.save(dir_scanned + os.path.basename(pdf_filename))
+        new_pdf.close()
+        doc.close()
+    print()
+    return sorted(code.data for code in truth)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end scan benchmark on a synthetic corpus')
+
+    parser.add_argument('-b', '--blur', help='Maximum blur sigma (pixels)', type=float, default=1.0)
+    parser.add_argument('-B', '--blank', help='Probability of a question left blank', type=float, default=0.1)
+    parser.add_argument('-d', '--dpi', help='Resolution of the synthetic scans', type=int, default=300)
+    parser.add_argument('-j', '--threads', help='Number of scanner workers', type=int, default=4)
+    parser.add_argument('-k', '--skew', help='Maximum skew (degrees)', type=float, default=1.5)
+    parser.add_argument('-m', '--darkness', help='Range of darkness of the marks (0-1)', type=float, nargs=2, default=[0.4, 0.9])
+    parser.add_argument('-n', '--number', help='Number of exams of the corpus (all if 0)', type=int, default=0)
+    parser.add_argument('-N', '--noise', help='Standard deviation of the noise (gray levels)', type=float, default=8.0)
+    parser.add_argument('-o', '--output', help='Save the report to a JSON file', type=str, default=None)
+    parser.add_argument('-q', '--quality', help='JPEG quality of the synthetic scans', type=int, default=70)
+    parser.add_argument('-r', '--rotate', help='Probability of a page rotated 90, 180 or 270 degrees', type=float, default=0.25)
+    parser.add_argument('-R', '--reuse', help='Reuse the corpus of the previous run', action="store_true")
+    parser.add_argument('-s', '--seed', help='Random seed', type=int, default=1)
+    parser.add_argument('-T', '--temp', help='Specify temp directory', type=str, default="/tmp")
+    parser.add_argument('-z', '--scale', help='Maximum scale error (fraction)', type=float, default=0.02)
+    parser.add_argument('scanner_args', help='Extra qrscanner arguments, after -- (e.g. -- -l 150 -o)', nargs="*")
+
+    args = vars(parser.parse_args())
+
+    if not check_workspace():
+        print("ERROR: qrbench must be run from a workspace directory (with the exams already generated)")
+        sys.exit(1)
+
+    date = get_date()
+    prefix = date + "_"
+    _, dir_data, _, dir_generated, _, _, _ = get_workspace_paths(os.getcwd())
+
+    # The benchmark runs in a workspace of its own, the real one is never touched
+    dir_bench = args.get("temp") + os.sep + "qrbench" + os.sep + "qrgrading-" + date
+    _, bench_data, bench_scanned, _, bench_xls, bench_publish, _ = get_workspace_paths(dir_bench)
+    truth_filename = dir_bench + os.sep + "truth.json"
+
+    if not args.get("reuse") or not os.path.exists(truth_filename):
+        generated = Generated(72 / 25.4)
+        if not generated.load(dir_data + prefix + "generated.csv"):
+            print(f"ERROR: file {prefix + 'generated.csv'} not found")
+            sys.exit(1)
+
+        for directory in (bench_data, bench_scanned, bench_xls, bench_publish):
+            makedir(directory, clear=True)
+        shutil.copy(dir_data + prefix + "generated.csv", bench_data)
+
+        pdf_filenames = sorted([dir_generated + f for f in os.listdir(dir_generated) if f.endswith(".pdf")])
+        pdf_filenames = pdf_filenames[:args.get("number")] if args.get("number") > 0 else pdf_filenames
+
+        print(">> Creating synthetic corpus ({} exams at {} dpi)".format(len(pdf_filenames), args.get("dpi")))
+        truth = create_corpus(pdf_filenames, generated, bench_scanned, np.random.default_rng(args.get("seed")), args)
+        with open(truth_filename, "w", encoding='utf-8') as f:
+            json.dump(truth, f)
+
+    with open(truth_filename, "r", encoding='utf-8') as f:
+        truth = set(json.load(f))
+
+    # Cache disabled (unless given in the extra arguments) to measure the real work
+    print(">> Running qrscanner ({} workers)".format(args.get("threads")))
+    stats_filename = dir_bench + os.sep + "stats.json"
+    command = [sys.executable, "-m", "qrgrader.qrscanner", "-s", "-j", str(args.get("threads")), "-K", "0",
+               "-T", dir_bench + os.sep + "tmp", "-m", stats_filename] + args.get("scanner_args")
+    time_begin = time.time()
+    subprocess.run(command, cwd=dir_bench, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.time() - time_begin
+
+    with open(stats_filename, "r", encoding='utf-8') as f:
+        stats = json.load(f)
+
+    # A code is predicted as marked if it was not decoded, missing codes count as not marked
+    codes = CodeSet()
+    codes.load(bench_data + prefix + "detected.csv")
+    marked = {code.data for code in codes if code.marked and code.type in (Code.TYPE_A, Code.TYPE_N)}
+    tp, fp, fn = len(marked & truth), len(marked - truth), len(truth - marked)
+
+    report = {
+        "pages": stats.get("pages"),
+        "workers": args.get("threads"),
+        "scan_seconds": stats.get("wall"),
+        "total_seconds": elapsed,
+        "pages_per_second": stats.get("pages") / stats.get("wall"),
+        "peak_rss_mb": stats.get("rss"),
+        "marks": len(truth),
+        "true_positives": tp,
+        "false_positives": fp,
+        "false_negatives": fn,
+        "precision": tp / (tp + fp) if tp + fp > 0 else 1.0,
+        "recall": tp / (tp + fn) if tp + fn > 0 else 1.0,
+    }
+
+    print(">> Results")
+    print("   Pages:            {} in {:.2f} s ({:.2f} pages/s, {:.2f} s with start-up)".format(
+        report["pages"], report["scan_seconds"], report["pages_per_second"], report["total_seconds"]))
+    print("   Peak RSS (MB):    {}".format(" ".join("{:.0f}".format(rss) for rss in report["peak_rss_mb"])))
+    print("   Marks:            {} (TP {}, FP {}, FN {})".format(len(truth), tp, fp, fn))
+    print("   Precision/recall: {:.4f} / {:.4f}".format(report["precision"], report["recall"]))
+
+    if args.get("output") is not None:
+        with open(args.get("output"), "w", encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
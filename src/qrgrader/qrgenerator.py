@@ -6,11 +6,13 @@ import argparse
 import os.path
 import re
 import sys
+import time
 from multiprocessing import Manager
 from os import listdir
 
 from qrgrader.common import get_workspace_paths, get_temp_paths, check_workspace, get_date, get_prefix
 from qrgrader.generator import Generator
+from qrgrader.tracing import Trace
 from qrgrader.utils import makedir
 
 
@@ -20,6 +22,7 @@ def main():
     parser.add_argument('-c', '--cleanup', help='Clear pool files', action='store_true')
     parser.add_argument('-f', '--filename', help='Specify .tex filename', default=None)
     parser.add_argument('-j', '--threads', help='Maximum number of threads to use (4)', default=4, type=int)
+    parser.add_argument('-k', '--trace', help='Save the timeline of the compilations to a Chrome trace (JSON) file', type=str, default=None)
     parser.add_argument('-n', '--number', help='Number or exams to be generated', default=0, type=int)
     parser.add_argument('-P', '--pages', help='Acceptable number of pages of output PDF', default=-1, type=int)
     parser.add_argument('-T', '--temp', help='Specify temp directory', type=str, default="/tmp")
@@ -80,11 +83,15 @@ def main():
 
         with Manager() as manager:
             queue = manager.BoundedSemaphore(threads)
+            trace = Trace() if args.get("trace") else None
+            spans = manager.list() if trace is not None else None
 
             i = begin
 
             while i < end and len(os.listdir(dir_generated)) < number + begin - 1:
+                wait = time.perf_counter()
                 queue.acquire()
+                trace is not None and trace.add("main", "acquire", wait, time.perf_counter())
 
                 procs = [p for p in processes if not p.is_alive()].copy()
                 for process in procs:
@@ -97,16 +104,33 @@ def main():
                               dir_generated=dir_generated,
                               dir_source=source,
                               desired_pages=desired_pages,
-                              verbose=verbose)
+                              verbose=verbose,
+                              trace=spans)
 
                 processes.append(p)
+                start = time.perf_counter()
                 p.start()
+                trace is not None and trace.add("main", "start", start, time.perf_counter(), exam=p.uniqueid)
                 i += 1
 
             for p in processes:
                 p.join()
             processes.clear()
 
+            if trace is not None:
+                # Each exam is a process of its own: they are laid out in as
+                # many tracks as compilations were running at the same time
+                trace.track("main")
+                exams = {}
+                for uniqueid, name, span_begin, span_end in spans:
+                    exams.setdefault(uniqueid, []).append((name, span_begin, span_end))
+                for uniqueid, exam_spans in sorted(exams.items(), key=lambda item: min(span[1] for span in item[1])):
+                    _, exam_begin, exam_end = next(span for span in exam_spans if span[0] == "exam")
+                    track = trace.lane(exam_begin, exam_end)
+                    for name, span_begin, span_end in exam_spans:
+                        trace.add(track, uniqueid if name == "exam" else name, span_begin, span_end)
+                trace.save(args.get("trace"))
+
             print("Done ({:d} exams generated).".format(len(os.listdir(dir_generated))))
 
     if create_generated:
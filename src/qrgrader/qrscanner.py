@@ -1,11 +1,14 @@
 import argparse
+import json
 import os
+import queue
 import shutil
+import signal
 import sys
 import time
 from itertools import accumulate
-from multiprocessing import Manager, Pool, Process
-from random import randint
+from multiprocessing import Pool, Process, Queue
+from random import randint, seed
 
 import qrgrader.utils as utils
 import cv2
@@ -17,34 +20,175 @@ from pymupdf.mupdf import PDF_ENCRYPT_KEEP
 
 from qrgrader.code import Code
 from qrgrader.code_set import CodeSet, PageCodeSet
+from qrgrader.code_table import CodeTable
 from qrgrader.common import check_workspace, get_workspace_paths, get_temp_paths, Generated, Questions, get_date, Nia, \
     StudentsData, Nia
+from qrgrader.journal import Journal
+from qrgrader.page_cache import PageCache
 from qrgrader.page_processor import PageProcessor
+from qrgrader.stats import Stats
+from qrgrader.tracing import Trace
 from qrgrader.utils import makedir
+from qrgrader.watcher import DirectoryWatcher
 from datetime import timedelta
 
 
+def get_page_ranges(files, workers, skip=(), min_chunk=1):
+    # Guided scheduling: chunks start big (fewer document opens) and shrink
+    # as the work left decreases, so that the last pages of the session are
+    # spread among all the workers. Workers take the next range from a shared
+    # queue as soon as they are free, which balances files of different sizes.
+    # Pages in skip, as (filename, index), are left out
+    pending = [(filename, [i for i in range(first, length) if (filename, i) not in skip])
+               for _, filename, first, length in files]
+    remaining = sum(len(pages) for _, pages in pending)
+    ranges = []
+    for filename, pages in pending:
+        start = 0
+        while start < len(pages):
+            chunk = max(min_chunk, remaining // (2 * workers))
+            # Only consecutive pages in the same range
+            end = start + 1
+            while end < min(start + chunk, len(pages)) and pages[end] == pages[end - 1] + 1:
+                end += 1
+            ranges.append((filename, pages[start], pages[end - 1] + 1))
+            remaining -= end - start
+            start = end
+    return ranges
+
+
+def count_pages(filename):
+    document = pymupdf.open(filename)
+    length = len(document)
+    document.close()
+    return length
+
+
+def reconstruct_exams(exams, date, dir_images, dir_publish):
+    images = os.listdir(dir_images)
+    for exam in exams:
+        filename = dir_publish + "{}{:03d}.pdf".format(date, exam)
+        pdf_file = pymupdf.open()
+        exam_images = sorted([x for x in images if x.startswith("page-{}-{}-".format(date, exam))])
+        for image in exam_images:
+            page = pdf_file.new_page()  # noqa
+            page.insert_image(pymupdf.Rect(0, 0, 595.28, 842), filename=dir_images + os.sep + image)
+
+        pdf_file.save(filename)
+
+
+def simulate_chunk(task):
+    # Marks random answers in a chunk of generated exams and saves them,
+    # rendered as a copier would, in a single PDF
+    pdf_filenames, dir_generated, dir_scanned, generated_filename, dpi = task
+    output = "{}-{}".format(pdf_filenames[0][:-4], pdf_filenames[-1][6:9])
+
+    # The workers are forked with the same random state
+    seed()
+
+    generated = Generated(72 / 25.4)
+    generated.load(generated_filename)
+
+    # The new pages are appended to the file every few pages,
+    # so that the memory used does not grow with the chunk
+    new_pdf, pages = pymupdf.open(), 0
+
+    for pdf_filename in pdf_filenames:
+        doc = pymupdf.open(dir_generated + pdf_filename)
+
+        exam = pdf_filename[6:9]
+
+        for page in doc:
+
+            filtered = generated.select(type=Code.TYPE_A, exam=int(exam), page=page.number + 1)
+            for question in filtered.get_questions():
+                qrs = filtered.select(type=Code.TYPE_A, question=question)
+                for qr in qrs:
+                    if qr.answer == randint(1, 4):
+                        x = qr.x + 5
+                        y = qr.y - 7
+                        w = 10
+                        h = 10
+                        annot = page.add_redact_annot(pymupdf.Rect(x, y, x + w, y + h), fill=(0.5, 0.5, 0.5), cross_out=False)
+                        break
+
+            nias = generated.select(type=Code.TYPE_N, exam=int(exam), page=page.number + 1)
+            if len(nias) > 0:
+                figures = max([nia.number//10 for nia in nias])
+                for i in range(figures + 1):
+                    r = randint(0, 9)
+                    qr = nias.first(number=i * 10 + r)
+                    if qr is not None:
+                        x = qr.x + 5
+                        y = qr.y - 7
+                        w = 10
+                        h = 10
+                        annot = page.add_redact_annot(pymupdf.Rect(x, y, x + w, y + h), fill=(0.5, 0.5, 0.5), cross_out=False)
+
+            # Apply the redactions
+            page.apply_redactions()
+            # Get the images with the marked codes
+            pix = page.get_pixmap(matrix=pymupdf.Matrix(dpi / 72, dpi / 72))
+            # Insert the new page and the image inside it
+            new_page = new_pdf.new_page()
+            new_page.insert_image(new_page.rect, stream=pix.tobytes("jpg"), width=pix.width, height=pix.height)
+            # To be sure avoiding memory leaks
+            del pix
+
+            pages += 1
+            if pages % 16 == 0:
+                new_pdf = flush_pdf(new_pdf, dir_scanned + output + ".pdf")
+
+        doc.close()
+
+    flush_pdf(new_pdf, dir_scanned + output + ".pdf").close()
+    return output + ".pdf"
+
+
+def flush_pdf(pdf, filename):
+    # Writes the pages added so far and returns the document reopened
+    if pdf.name:
+        pdf.saveIncr()
+    else:
+        pdf.save(filename)
+    pdf.close()
+    return pymupdf.open(filename)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Patching and detection')
 
     parser.add_argument('-a', '--annotate', help='Annotate files', action="store_true")
+    parser.add_argument('-b', '--decode', help='Decode the codes of each patch, of the whole page or of 6 tiles (patches)', choices=["patches", "page", "tiles"], default="patches")
     parser.add_argument('-B', '--begin', type=int, help='First page to process', default=0)
     parser.add_argument('-c', '--correct', help='Correct QRs position (according to -x -y and -z)', action="store_true")
     parser.add_argument('-C', '--encrypt', help='Encrypt PDF files', action="store_true")
+    parser.add_argument('-K', '--cache', help='Size (MB) of the cache of scanned pages, 0 to disable it', type=int, default=512)
     parser.add_argument('-d', '--dpi', help='Dot per inch', type=int, default=400)
     parser.add_argument('-e', '--reconstruct', help='Reconstruct exams', action="store_true")
     parser.add_argument('-E', '--end', type=int, help='Last page to process', default=None)
     parser.add_argument('-g', '--export', type=str, help='Export project for storage', default=None)
+    parser.add_argument('-I', '--images', help='Decode the scanned images at their own resolution instead of rendering the pages (faster, may find fewer marks)', action="store_true")
+    parser.add_argument('-i', '--fixed-thresholds', help='Always try the thresholds in the default order (no auto-tuning)', action="store_true")
     parser.add_argument('-j', '--threads', help='Number of threads to be used for processing', type=int, default=4)
+    parser.add_argument('-l', '--low-dpi', help='Try first at this dpi and use --dpi only when needed', type=int, default=0)
+    parser.add_argument('-k', '--trace', help='Save the timeline of the workers to a Chrome trace (JSON) file', type=str, default=None)
+    parser.add_argument('-m', '--stats', help='Print the time spent in each stage of the scan (and save it to a JSON file if given)', nargs="?", const="", default=None)
+    parser.add_argument('-M', '--max-residual', help='Report the pages whose codes fit the layout worse than this (mm)', type=float, default=1.0)
     parser.add_argument('-n', '--nia', help='Create NIA file', action="store_true")
+    parser.add_argument('-P', '--process-all', help='Process blank and non-exam pages too (no quick check)', action="store_true")
     parser.add_argument('-p', '--process', help='Options -sne', action="store_true")
     parser.add_argument('-q', '--postprocess', help='Options -nrta', action="store_true")
+    parser.add_argument('-o', '--roi', help='Decode only around the expected code positions', action="store_true")
     parser.add_argument('-R', '--ratio', type=int, help='Resize image to save space', default=0.25)
     parser.add_argument('-r', '--raw', help='Create RAW file', action="store_true")
     parser.add_argument('-s', '--scan', help='Process pages in scanned folder', action="store_true")
     parser.add_argument('-S', '--simulate', help='Create random marked files', type=int, default=0)
     parser.add_argument('-t', '--table', help='Generate table',action="store_true")
     parser.add_argument('-T', '--temp', help='Specify temp directory', type=str, default="/tmp")
+    parser.add_argument('-u', '--resume', help='Resume an interrupted scan (skip the pages already done)', action="store_true")
+    parser.add_argument('-v', '--verify-marks', help='Try to decode every box not decoded (no ink classifier)', action="store_true")
+    parser.add_argument('-w', '--watch', help='Keep scanning the new files of the scanned folder (Ctrl+C to stop)', action="store_true")
     parser.add_argument('-x', '--xdisp', help='Specify printer X displacement', type=float, default=0.0)
     parser.add_argument('-y', '--ydisp', help='Specify printer Y displacement', type=float, default=0.0)
     parser.add_argument('-z', '--zoom', help='Specify printer zoom', type=float, default=1.0)
@@ -123,63 +267,24 @@ def main():
         print("Simulation in progress ({} files)".format(simulate))
         makedir(dir_scanned, clear=True)
 
-        generated = Generated(72 / 25.4)
-
-        if not generated.load(dir_data + prefix + "generated.csv"):
+        if not os.path.exists(dir_data + prefix + "generated.csv"):
             print(f"ERROR: file {os.path.basename(dir_data + prefix + 'generated.csv')} not found")
             sys.exit(1)
 
         pdf_filenames = [f for f in os.listdir(dir_generated) if f.endswith(".pdf")]
         pdf_filenames.sort()
+        pdf_filenames = pdf_filenames[0:simulate]
 
-        for pdf_filename in pdf_filenames[0:simulate]:
-            print("Marking random answers in {}".format(pdf_filename), end="\r")
-
-            new_pdf = pymupdf.open()
-            doc = pymupdf.open(dir_generated + pdf_filename)
-
-            exam = pdf_filename[6:9]
-
-            for page in doc:
-
-                filtered = generated.select(type=Code.TYPE_A, exam=int(exam), page=page.number + 1)
-                for question in filtered.get_questions():
-                    qrs = filtered.select(type=Code.TYPE_A, question=question)
-                    for qr in qrs:
-                        if qr.answer == randint(1, 4):
-                            x = qr.x + 5
-                            y = qr.y - 7
-                            w = 10
-                            h = 10
-                            annot = page.add_redact_annot(pymupdf.Rect(x, y, x + w, y + h), fill=(0.5, 0.5, 0.5), cross_out=False)
-                            break
-
-                nias = generated.select(type=Code.TYPE_N, exam=int(exam), page=page.number + 1)
-                if len(nias) > 0:
-                    figures = max([nia.number//10 for nia in nias])
-                    for i in range(figures + 1):
-                        r = randint(0, 9)
-                        qr = nias.first(number=i * 10 + r)
-                        if qr is not None:
-                            x = qr.x + 5
-                            y = qr.y - 7
-                            w = 10
-                            h = 10
-                            annot = page.add_redact_annot(pymupdf.Rect(x, y, x + w, y + h), fill=(0.5, 0.5, 0.5), cross_out=False)
-
-                # Apply the redactions
-                page.apply_redactions()
-                # Get the images with the marked codes
-                pix = page.get_pixmap(matrix=pymupdf.Matrix(args.get("dpi") / 72, args.get("dpi") / 72))
-                # Insert the new page and the image inside it
-                new_page = new_pdf.new_page()
-                new_page.insert_image(new_page.rect, stream=pix.tobytes("jpg"), width=pix.width, height=pix.height)
-                # To be sure avoiding memory leaks
-                del pix
-
-            new_pdf.save(dir_scanned + pdf_filename)
-            new_pdf.close()
-            doc.close()
+        # Each worker marks a chunk of exams and writes them in a PDF of its own,
+        # as a copier would do with a batch. Chunks are kept small enough to
+        # balance the workers and to show some progress
+        chunk = max(1, min(25, -(-len(pdf_filenames) // args.get("threads"))))
+        chunks = [(pdf_filenames[i:i + chunk], dir_generated, dir_scanned, dir_data + prefix + "generated.csv", args.get("dpi"))
+                  for i in range(0, len(pdf_filenames), chunk)]
+
+        with Pool(args.get("threads")) as pool:
+            for i, output in enumerate(pool.imap_unordered(simulate_chunk, chunks)):
+                print("Marked random answers in {} ({}/{})".format(output, i + 1, len(chunks)), end="\r")
 
         print("\nSimulation done.")
 
@@ -194,72 +299,232 @@ def main():
             print(f"ERROR: file {os.path.basename(dir_data + prefix + 'generated.csv')} not found")
             sys.exit(1)
 
+        # The workers only receive the name of the memory-mapped table
+        generated = generated.publish(dir_temp_scanner + "generated.npy")
+
         files = []
         for i, filename in enumerate(sorted([x for x in os.listdir(dir_scanned) if x.endswith(".pdf")])):
-            document = pymupdf.open(dir_scanned + filename)
-            files.append((i, filename, first_page, len(document) if last_page is None else last_page))
-            document.close()
+            files.append((i, filename, first_page, count_pages(dir_scanned + filename) if last_page is None else last_page))
 
         total_length = sum(length-first for _, _, first, length in files)
-        if total_length <= 0:
+        if total_length <= 0 and not args.get("watch"):
             print("No pages to process. Exiting.")
             sys.exit(0)
         time_begin = time.time()
-        time_remaining = 0
-        elapsed = 0
-
-        with Manager() as manager:
-
-            done = 0
-            processes = []
-            detected = manager.list()
-            semaphore = manager.BoundedSemaphore(args.get("threads"))
-
-            for index, filename, first, length in files:
-
-                index > 0 and print() # for the \r at the end of the last line
-                print(f">> Processing file {filename} ({index+1}/{len(files)})")
-
-                for i in range(first, length):
-
-                    semaphore.acquire()
-                    done += 1
-
-                    procs = [p for p in processes if not p.is_alive()].copy()
-                    for process in procs:
-                        process.join()
-                        processes.remove(process)
 
-                    # We send the filename and open the document in the process for three reasons:
-                    # 1. Sending the page object is not possible because it is not pickable
-                    # 2. Rendering the page image in parallel make the whole process much faster
-                    # 3. For some reason sending the image to the process creates memory overflow
+        # Results of the pages already processed in previous runs
+        cache = None
+        if args.get("cache") > 0:
+            dir_temp_cache = os.path.dirname(os.path.dirname(dir_temp_scanner)) + os.sep + "cache" + os.sep
+            cache = PageCache(dir_temp_cache, args.get("cache") * 1024 * 1024)
+
+        # Binarization settings that worked in the previous session, tried first
+        threshold_history_filename = os.path.expanduser("~") + os.sep + ".config/qrgrader/thresholds.json"
+        threshold_history, session_history = None, {}
+        if not args.get("fixed_thresholds") and os.path.exists(threshold_history_filename):
+            try:
+                with open(threshold_history_filename, "r", encoding='utf-8') as f:
+                    threshold_history = json.load(f)
+            except ValueError:
+                print(f"WARNING: ignoring invalid file {threshold_history_filename}")
 
-                    process = PageProcessor(semaphore, dir_scanned + filename, i, generated, detected, dir_images=dir_temp_scanner, resize=args.get("ratio"))
-                    processes.append(process)
-                    process.start()
-
-                    #while len([p for p in processes if p.is_alive()]) >= 4:
-                    #    time.sleep(0.25)
-
-                    time_remaining = (time.time() - time_begin) / (done+1) * (total_length - done)
-                    h, r = divmod(int(time_remaining), 3600)
-                    m, s = divmod(r, 60)
-
-                    print(f"   Processed {done}/{total_length} ({100*done/total_length:.1f}%) ({len(detected)} codes found) remaining: {h:02}:{m:02}:{s:02}", end="\r")
-
-            print() # for the \r at the end of the last line
-
-            for process in processes:
-                process.join()
-
-            codes = CodeSet()
-            codes.extend(detected)
-            codes.save(dir_data + prefix + "detected.csv")
+        codes = CodeSet()
+        jobs, results = Queue(), Queue()
+        stats = Stats(args.get("stats") is not None)
+        trace = Trace() if args.get("trace") else None
+        tracks = {}
+
+        # Every page is written to the journal as soon as it is done, with
+        # --resume the pages already there are not processed again
+        journal = Journal(dir_data + prefix + "detected.journal")
+        journaled = journal.load() if args.get("resume") else {}
+        for record, info in journaled.values():
+            codes.loads(record)
+        journal.open(resume=args.get("resume"))
+
+        # Fewer pages than threads (re-scanning a few sheets): one worker per
+        # page, each one decoding the patches of its page with several threads
+        threads = args.get("threads")
+        pages = sum(max(length - first, 0) for _, _, first, length in files) - len(journaled)
+        processes = threads if args.get("watch") else max(1, min(threads, pages))
+
+        ranges = get_page_ranges(files, processes, skip=journaled)
+        total_length = sum(last - first for _, first, last in ranges)
+
+        # Pages still to come for each file, to know when a file is complete
+        pending = {}
+        for filename, first, last in ranges:
+            pending[dir_scanned + filename] = pending.get(dir_scanned + filename, 0) + last - first
+        if len(journaled) > 0:
+            print(f">> Resuming scan: {len(journaled)} pages already done, {total_length} to go")
+
+        # A fixed pool of workers pulls the pages from the jobs queue, this
+        # way we pay the process start-up (and the copy of the generated
+        # codes) once per worker instead of once per page
+        workers = [PageProcessor(jobs, results, generated, dir_images=dir_temp_scanner, resize=args.get("ratio"),
+                                 dpi=args.get("dpi"), roi=args.get("roi"), decode=args.get("decode"),
+                                 classifier=not args.get("verify_marks"), quick_check=not args.get("process_all"),
+                                 low_dpi=args.get("low_dpi"), decode_threads=threads // processes,
+                                 extract_images=args.get("images"), cache=cache, watch=args.get("watch"),
+                                 stats=stats.enabled, trace=trace is not None,
+                                 tune=not args.get("fixed_thresholds"), threshold_history=threshold_history)
+                   for _ in range(processes)]
+
+        for worker in workers:
+            worker.start()
+
+        # We send the filename and open the document in the process for three reasons:
+        # 1. Sending the page object is not possible because it is not pickable
+        # 2. Rendering the page image in parallel make the whole process much faster
+        # 3. For some reason sending the image to the process creates memory overflow
+        for filename, first, last in ranges:
+            jobs.put((dir_scanned + filename, first, last))
+
+        # Watch mode: the new files are sent to the workers as soon as
+        # they are completely written, Ctrl+C stops watching and the pages
+        # already sent are completed as usual
+        watcher = None
+        if args.get("watch"):
+            watcher = DirectoryWatcher(dir_scanned, known=[filename for _, filename, _, _ in files])
+
+            def stop_watching(signum, frame):
+                watcher.stop()
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+
+            signal.signal(signal.SIGINT, stop_watching)
+            print(f">> Watching {dir_scanned} for new files (Ctrl+C to stop)")
+        else:
+            for _ in workers:
+                jobs.put(None)
+
+        done, current, escalated, cached, exams_changed, last_poll = 0, None, 0, 0, set(), 0
+        misaligned, skipped = [], []
+        while done < total_length or watcher is not None:
+            if watcher is not None and (done == total_length or time.time() - last_poll > 1):
+                # Nothing to wait for from the workers: sleep on the directory
+                new_files = watcher.wait(1) if done == total_length else watcher.poll()
+                last_poll = time.time()
+                for filename in new_files:
+                    length = count_pages(dir_scanned + filename) if last_page is None else last_page
+                    new_ranges = get_page_ranges([(0, filename, first_page, length)], processes, skip=journaled)
+                    for _, first, last in new_ranges:
+                        jobs.put((dir_scanned + filename, first, last))
+                    pending[dir_scanned + filename] = sum(last - first for _, first, last in new_ranges)
+                    total_length += pending[dir_scanned + filename]
+                    print(f"\n>> New file {filename} ({pending[dir_scanned + filename]} pages)")
+
+                if not watcher.running:
+                    watcher.close()
+                    watcher = None
+                    for _ in workers:
+                        jobs.put(None)
+                if done == total_length:
+                    continue
+
+            # Each worker sends back a single record per page
+            try:
+                filename, i, record, info, page_stats = results.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    print("\nERROR: all the workers have died, saving partial results")
+                    break
+                continue
+
+            # Failed pages are not journaled, a resumed scan tries them again
+            codes.loads(record)
+            stats.merge(page_stats)
+            if trace is not None and page_stats is not None:
+                # One track per thread of each worker, the stages are nested in the
+                # page span (on the main thread) or in the decode of a region
+                number = tracks.setdefault(page_stats["pid"], len(tracks) + 1)
+                for name, begin, end, thread in page_stats["spans"]:
+                    key = (page_stats["pid"], thread)
+                    trace.track(key, "worker {}".format(number) if thread == "MainThread" else "worker {} {}".format(number, thread))
+                    span_args = dict(file=os.path.basename(filename), page=i) if name == "page" else {}
+                    trace.add(key, name, begin, end, **span_args)
+            info.get("error") or journal.append(os.path.basename(filename), i, record, info)
+            escalated += info.get("escalated", False)
+            for stage, histogram in info.get("thresholds", {}).items():
+                for th, n in histogram.items():
+                    session_history.setdefault(stage, {})[th] = session_history.get(stage, {}).get(th, 0) + n
+            cached += info.get("cached", False)
+            if info.get("skipped"):
+                skipped.append((os.path.basename(filename), i, info["skipped"]))
+            if (info.get("residual") or 0) > args.get("max_residual"):
+                misaligned.append((info.get("image"), info.get("residual")))
+            done += 1
+
+            # Watch mode: results updated every time a file is complete
+            if info.get("image", "").startswith("page-"):
+                exams_changed.add(int(info["image"].split("-")[2]))
+            pending[filename] -= 1
+            if watcher is not None and pending[filename] == 0:
+                codes.save(dir_data + prefix + "detected.csv")
+                if args.get("reconstruct"):
+                    reconstruct_exams(sorted(exams_changed), codes.get_date(), dir_temp_scanner, dir_publish)
+                exams_changed.clear()
+
+            if filename != current:
+                current = filename
+                done > 1 and print() # for the \r at the end of the last line
+                print(f">> Processing file {os.path.basename(filename)}")
+
+            time_remaining = (time.time() - time_begin) / done * (total_length - done)
+            h, r = divmod(int(time_remaining), 3600)
+            m, s = divmod(r, 60)
+
+            print(f"   Processed {done}/{total_length} ({100*done/total_length:.1f}%) ({len(codes)} codes found) remaining: {h:02}:{m:02}:{s:02}", end="\r")
+
+        print() # for the \r at the end of the last line
+
+        if args.get("low_dpi"):
+            print(f"   {escalated}/{done} pages processed again at {args.get('dpi')} dpi")
+
+        if cache is not None:
+            print(f"   {cached}/{done} pages taken from the cache")
+
+        # Blank pages are expected (duplex scans), the others are listed
+        if len(skipped) > 0:
+            blank = sum(reason == "blank" for _, _, reason in skipped)
+            print(f"   {len(skipped)}/{done} pages skipped ({blank} blank, {len(skipped) - blank} without codes)")
+            for filename, i, reason in sorted(skipped):
+                reason != "blank" and print(f"      {filename} page {i + 1}")
+
+        # Candidates for the "Move Codes" dialog of the grader
+        if len(misaligned) > 0:
+            print(f"   {len(misaligned)}/{done} pages with an alignment residual above {args.get('max_residual')} mm:")
+            for image, residual in sorted(misaligned, key=lambda item: -item[1]):
+                print(f"      {image}: {residual:.2f} mm")
+
+        if trace is not None:
+            trace.save(args.get("trace"))
+
+        if args.get("stats") is not None:
+            print(f">> Time per stage ({processes} workers, {time.time() - time_begin:.2f} s)")
+            print(stats.table())
+            if args.get("stats"):
+                stats.save(args.get("stats"), wall=time.time() - time_begin, workers=processes, pages=done)
+
+        for worker in workers:
+            worker.join()
+
+        if cache is not None:
+            cache.evict()
+
+        if len(session_history) > 0:
+            makedir(os.path.dirname(threshold_history_filename))
+            with open(threshold_history_filename, "w", encoding='utf-8') as f:
+                json.dump(session_history, f, indent=2)
+
+        # The journal is compacted into detected.csv, kept if the scan is not complete
+        codes.save(dir_data + prefix + "detected.csv")
+        journal.close(remove=done == total_length)
 
     if args.get("reconstruct") or args.get("nia") or args.get("raw") \
             or args.get("annotate") or args.get("encrypt") or args.get("table"):
-        codes = CodeSet()
+        # Read-only from here on: the columnar set loads several times faster,
+        # selects as fast, and iterating it (CodeView objects) is slower
+        codes = CodeTable()
         if not codes.load(dir_data + prefix + "detected.csv"):
             print(f"ERROR: file {os.path.basename(dir_data + prefix + 'detected.csv')} not found")
             sys.exit(1)
@@ -269,16 +534,7 @@ def main():
 
     if args.get("reconstruct"):
         print(">> Reconstructing exams")
-        images = os.listdir(dir_temp_scanner)
-        for exam in exams:
-            filename = dir_publish + "{}{:03d}.pdf".format(date, exam)
-            pdf_file = pymupdf.open()
-            exam_images = sorted([x for x in images if x.startswith("page-{}-{}-".format(date, exam))])
-            for image in exam_images:
-                page = pdf_file.new_page()  # noqa
-                page.insert_image(pymupdf.Rect(0, 0, 595.28, 842), filename=dir_temp_scanner + os.sep + image)
-
-            pdf_file.save(filename)
+        reconstruct_exams(exams, date, dir_temp_scanner, dir_publish)
 
 
     if args.get("nia"):
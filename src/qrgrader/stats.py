@@ -0,0 +1,125 @@
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss():
+    # Peak resident memory of this process in MB, None if not available
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+class Stats:
+    """Wall time and calls of each stage of the page pipeline, plus counters.
+
+    Stages may be nested (e.g. decode inside orientation), so their times
+    overlap. With trace=True every stage is also kept as a (name, begin, end,
+    thread) span for the timeline, one track per thread: the decode threads
+    of a page overlap, their spans can not share the track of the worker.
+    A disabled instance does nothing: stage() returns a shared no-op context
+    and count() returns at once.
+    """
+
+    class Stage:
+        __slots__ = ("entry", "spans", "name", "begin", "lock")
+
+        def __init__(self, entry, spans, name, lock):
+            self.entry = entry
+            self.spans = spans
+            self.name = name
+            self.lock = lock
+
+        def __enter__(self):
+            self.begin = time.perf_counter()
+            return self
+
+        def __exit__(self, *args):
+            end = time.perf_counter()
+            with self.lock:
+                self.entry[0] += end - self.begin
+                self.entry[1] += 1
+            if self.spans is not None:
+                self.spans.append((self.name, self.begin, end, threading.current_thread().name))
+
+    class Nothing:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    NOTHING = Nothing()
+
+    def __init__(self, enabled=True, trace=False):
+        self.enabled = enabled or trace
+        self.trace = trace
+        self.times = {}
+        self.counts = {}
+        self.spans = [] if trace else None
+        self.rss = {}
+        self.lock = self.NOTHING
+
+    def threaded(self):
+        # Stages and counters updated from several threads (created here,
+        # not in the constructor, because a lock can not be pickled)
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        if not self.enabled:
+            return self.NOTHING
+        with self.lock:
+            return self.Stage(self.times.setdefault(name, [0.0, 0]), self.spans, name, self.lock)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def take(self):
+        # What was recorded since the last call, to be sent to the main process
+        if not self.enabled:
+            return None
+        data = {"times": self.times, "counts": self.counts, "spans": self.spans, "pid": os.getpid(), "rss": peak_rss()}
+        self.times, self.counts, self.spans = {}, {}, [] if self.trace else None
+        return data
+
+    def merge(self, data):
+        for name, (seconds, calls) in (data or {}).get("times", {}).items():
+            entry = self.times.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+        for name, n in (data or {}).get("counts", {}).items():
+            self.counts[name] = self.counts.get(name, 0) + n
+        if (data or {}).get("rss") is not None:
+            self.rss[data["pid"]] = max(self.rss.get(data["pid"], 0), data["rss"])
+
+    def table(self):
+        # Percentages are relative to the time spent in the pages (all workers)
+        total = self.times.get("page", [0.0, 0])[0] or 1.0
+        lines = ["   {:<14}{:>10}{:>12}{:>12}{:>8}".format("STAGE", "CALLS", "TOTAL (s)", "MEAN (ms)", "%")]
+        for name, (seconds, calls) in sorted(self.times.items(), key=lambda item: -item[1][0]):
+            lines.append("   {:<14}{:>10}{:>12.2f}{:>12.2f}{:>8.1f}".format(name, calls, seconds, 1000 * seconds / max(calls, 1),
+                                                                             100 * seconds / total))
+        lines.append("")
+        lines.append("   {:<14}{:>10}".format("COUNTER", "VALUE"))
+        for name, n in sorted(self.counts.items()):
+            lines.append("   {:<14}{:>10}".format(name, n))
+        if len(self.rss) > 0:
+            lines.append("")
+            lines.append("   Peak RSS per worker (MB): " + " ".join("{:.0f}".format(rss) for rss in self.rss.values()))
+        return "\n".join(lines)
+
+    def save(self, filename, **extra):
+        with open(filename, "w", encoding='utf-8') as f:
+            json.dump(dict(extra, stages={name: {"seconds": seconds, "calls": calls}
+                                          for name, (seconds, calls) in self.times.items()},
+                           counters=self.counts, rss=list(self.rss.values())), f, indent=2)
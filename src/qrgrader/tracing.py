@@ -0,0 +1,42 @@
+import json
+import time
+
+
+class Trace:
+    """Timeline in Chrome trace-event format (chrome://tracing, Perfetto).
+
+    Spans are (name, begin, end) with time.perf_counter() times, which are
+    comparable among the processes of the same machine. Each track is a
+    "thread" of the trace, spans contained in others are shown nested.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.tracks = {}
+        self.lanes = []
+
+    def track(self, key, name=None):
+        if key not in self.tracks:
+            self.tracks[key] = len(self.tracks) + 1
+            self.events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": self.tracks[key],
+                                "args": {"name": name or str(key)}})
+        return self.tracks[key]
+
+    def lane(self, begin, end):
+        # First track free at begin, for spans that do not come from a known
+        # worker (spans must be given sorted by begin)
+        for i, last in enumerate(self.lanes):
+            if last <= begin:
+                self.lanes[i] = end
+                return "worker {}".format(i + 1)
+        self.lanes.append(end)
+        return "worker {}".format(len(self.lanes))
+
+    def add(self, key, name, begin, end, **args):
+        self.events.append({"name": name, "ph": "X", "pid": 1, "tid": self.track(key),
+                            "ts": (begin - self.origin) * 1e6, "dur": (end - begin) * 1e6, "args": args})
+
+    def save(self, filename):
+        with open(filename, "w", encoding='utf-8') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
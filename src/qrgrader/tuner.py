@@ -0,0 +1,49 @@
+class ThresholdTuner:
+    """Order in which the binarization settings are tried, per stage.
+
+    Pages of the same batch behave alike: the settings that worked on the
+    last pages (exponentially decayed success counts) are tried first, the
+    others follow in the default order, so a page that does not fit the
+    estimate still gets all of them. The histogram of a previous session
+    is only a prior, scaled down so that a few pages of this batch win.
+    """
+
+    PRIOR = 3.0
+
+    def __init__(self, candidates, history=None, enabled=True, decay=0.9):
+        self.candidates = list(candidates)
+        self.enabled = enabled
+        self.decay = decay
+        self.scores = {}
+        self.orders = {}
+        self.counts = {}
+
+        keys = {str(th): th for th in self.candidates}
+        for stage, histogram in (history or {}).items():
+            total = sum(histogram.values()) or 1
+            self.scores[stage] = {keys[key]: self.PRIOR * n / total for key, n in histogram.items() if key in keys}
+
+    def order(self, stage):
+        if not self.enabled:
+            return self.candidates
+        if stage not in self.orders:
+            scores = self.scores.get(stage, {})
+            self.orders[stage] = sorted(self.candidates, key=lambda th: -scores.get(th, 0))
+        return self.orders[stage]
+
+    def success(self, stage, th):
+        if not self.enabled:
+            return
+        scores = self.scores.setdefault(stage, {})
+        for key in scores:
+            scores[key] *= self.decay
+        scores[th] = scores.get(th, 0) + 1
+        self.orders.pop(stage, None)
+
+        histogram = self.counts.setdefault(stage, {})
+        histogram[str(th)] = histogram.get(str(th), 0) + 1
+
+    def take(self):
+        # Successes since the last call, for the histogram of the session
+        counts, self.counts = self.counts, {}
+        return counts
@@ -14,12 +14,29 @@ from PyQt5.QtWidgets import QProgressDialog
 
 
 def pix2np(pix):
+    if pix.n == 1:
+        # Grayscale pixmaps are used as they are, no copy needed
+        return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w)
     im = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
     im = np.ascontiguousarray(im[..., [2, 1, 0]])  # rgb to bgr
     return im
 
 
 def threshold(orig, th):
+    # th is a percentage of white, or "otsu" or "adaptive"
+    if isinstance(th, str):
+        gray = orig if orig.ndim == 2 else cv2.cvtColor(orig, cv2.COLOR_BGR2GRAY)
+        if th == "otsu":
+            ret, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+        else:
+            thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 51, 10)
+        return thresh
+
+    if orig.ndim == 2:
+        # Single channel: binarize and invert in just one pass
+        ret, thresh = cv2.threshold(orig, 200 if th == 0 else 255 * float(th) / 100, 255, cv2.THRESH_BINARY_INV)
+        return thresh
+
     if th == 0:
         img = orig.copy()
     else:
@@ -72,10 +89,11 @@ def get_patches(orig, ppm, size_mm, tolerance=0.25):
     return patches
 
 
-def get_codes(patch):
+def get_codes(patch, **kwargs):
+    # kwargs are passed to the decoder, e.g. try_downscale=False for a cheaper pass
     codes = set()
     if patch.shape[0] > 0 and patch.shape[1] > 0:
-        results = zxingcpp.read_barcodes(patch, formats=zxingcpp.BarcodeFormat.Aztec | zxingcpp.BarcodeFormat.QRCode)
+        results = zxingcpp.read_barcodes(patch, formats=zxingcpp.BarcodeFormat.Aztec | zxingcpp.BarcodeFormat.QRCode, **kwargs)
         for result in results:
             if result.text not in codes:
                 top_left_x = min(result.position.top_left.x, result.position.bottom_right.x)
@@ -118,6 +136,48 @@ def get_similarity_transform(p1, p2):
 
     return transform_point
 
+def fit_similarity(p1, p2, tolerance, samples=300):
+    # Least-squares similarity from the points p1 to p2 (lists of (x, y)), robust
+    # to wrong pairs: the pair of points that agrees with most of the others
+    # (RANSAC over at most samples pairs) selects the inliers, which are fitted.
+    # Points are complex numbers, so the transform is just p2 = a * p1 + b.
+    # Returns the transform, the RMS residual of the inliers and their mask
+    p1 = np.array(p1, dtype=np.float64) @ (1, 1j)
+    p2 = np.array(p2, dtype=np.float64) @ (1, 1j)
+    n = len(p1)
+
+    i, j = np.triu_indices(n, 1)
+    if len(i) > samples:
+        chosen = np.random.default_rng(0).choice(len(i), samples, replace=False)
+        i, j = i[chosen], j[chosen]
+    valid = p1[i] != p1[j]
+    i, j = i[valid], j[valid]
+
+    if len(i) == 0:
+        inliers = np.ones(n, dtype=bool)
+    else:
+        a = (p2[j] - p2[i]) / (p1[j] - p1[i])
+        b = p2[i] - a * p1[i]
+        errors = np.abs(a[:, None] * p1 + b[:, None] - p2)
+        votes = (errors < tolerance).sum(axis=1)
+        # Most inliers, then the smallest error among them
+        best = np.lexsort((np.where(errors < tolerance, errors, 0).sum(axis=1), -votes))[0]
+        inliers = errors[best] < tolerance
+
+    c1, c2 = p1[inliers].mean(), p2[inliers].mean()
+    d1, d2 = p1[inliers] - c1, p2[inliers] - c2
+    norm = (np.abs(d1) ** 2).sum()
+    a = (d2 * d1.conj()).sum() / norm if norm > 0 else 1
+    b = c2 - a * c1
+    residual = float(np.sqrt((np.abs(a * p1[inliers] + b - p2[inliers]) ** 2).mean()))
+
+    def transform_point(pt):
+        q = a * complex(pt[0], pt[1]) + b
+        return q.real, q.imag
+
+    return transform_point, residual, inliers
+
+
 def compute_similarity_transform(p11, p12, p21, p22):
     # Convert points to numpy arrays
     p11, p12, p21, p22 = map(np.array, [p11, p12, p21, p22])
@@ -0,0 +1,97 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+import pymupdf
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+
+class DirectoryWatcher:
+    """New files of a directory, reported once they are completely written.
+
+    inotify (when available) is only used to wake up as soon as something
+    changes in the directory, otherwise the directory is polled. A file is
+    complete when its size has not changed for settle seconds and it can be
+    opened as a PDF without repairing it, because the copier (or the network
+    share) may close and reopen it several times while writing it.
+    """
+
+    def __init__(self, directory, suffix=".pdf", settle=2.0, known=()):
+        self.directory = directory
+        self.suffix = suffix
+        self.settle = settle
+        self.known = set(known)
+        self.candidates = {}
+        self.running = True
+        self.fd = self.inotify()
+
+    def inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, self.directory.encode(), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def wait(self, timeout):
+        # Sleep until something happens in the directory, the
+        # events themselves are not needed: poll() checks everything
+        if self.fd is None:
+            time.sleep(timeout)
+        elif select.select([self.fd], [], [], timeout)[0]:
+            try:
+                os.read(self.fd, 65536)
+            except BlockingIOError:
+                pass
+        return self.poll()
+
+    def poll(self):
+        now, ready = time.time(), []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(self.suffix) or name.startswith(".") or name in self.known:
+                continue
+            try:
+                stat = os.stat(self.directory + name)
+            except OSError:
+                continue
+
+            # (size, mtime, since when it has not changed)
+            size, mtime, since = self.candidates.get(name, (None, None, now))
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.candidates[name] = (stat.st_size, stat.st_mtime, now)
+            elif now - since >= self.settle and self.is_complete(name, now - since):
+                self.known.add(name)
+                del self.candidates[name]
+                ready.append(name)
+        return ready
+
+    def is_complete(self, name, stable):
+        try:
+            document = pymupdf.open(self.directory + name)
+        except Exception:
+            return False
+        # A truncated PDF is repaired when opened, accepted anyway
+        # if it does not change for a long time (it may be just broken)
+        complete = len(document) > 0 and (not document.is_repaired or stable >= 5 * self.settle)
+        document.close()
+        return complete
+
+    def stop(self):
+        # Called from the SIGINT handler: the descriptor is closed by close()
+        self.running = False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The package lives in src/, tests run without installing it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
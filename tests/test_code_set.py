@@ -0,0 +1,106 @@
+import random
+
+from qrgrader.code import Code
+from qrgrader.code_set import CodeSet, PageCodeSet
+
+
+def answers(exams=3, questions=4, page=1):
+    return [Code("2501010{:02d}{:02d}{}".format(exam, question, answer), 1, 2, 3, 4, page, page)
+            for exam in range(1, exams + 1) for question in range(1, questions + 1) for answer in range(1, 5)]
+
+
+def scan(codes, **kwargs):
+    # What select must return: the codes of the set that match, in order
+    return [code.data for code in codes if all(getattr(code, key, None) == value for key, value in kwargs.items())]
+
+
+def check(codes, **kwargs):
+    assert [code.data for code in codes.select(**kwargs)] == scan(codes, **kwargs)
+
+
+def test_append_and_remove_keep_the_indexes():
+    codes = CodeSet()
+    codes.extend(answers())
+    check(codes, exam=2, question=3)
+
+    extra = Code("250101002051", 1, 2, 3, 4, 2, 2)
+    codes.append(extra)
+    check(codes, exam=2)
+    check(codes, question=5)
+
+    codes.remove(extra)
+    codes.remove(codes.first(exam=1, question=1, answer=1))
+    check(codes, exam=2)
+    check(codes, exam=1, question=1)
+    assert codes.first(question=5) is None
+
+
+def test_replaced_code_keeps_its_place():
+    codes = CodeSet()
+    codes.extend(answers())
+    check(codes, page=1)
+
+    # Same data in another page: the position is kept, the page indexes follow
+    replacement = Code("250101002031", 9, 9, 3, 4, 2, 2)
+    codes.append(replacement)
+    assert list(codes).index(replacement) == 4 * 4 + 2 * 4
+    check(codes, page=1)
+    check(codes, page=2)
+    check(codes, exam=2, page=2)
+
+
+def test_page_changes_are_seen_by_select():
+    codes = CodeSet()
+    codes.extend(answers())
+    check(codes, page=1)
+    check(codes, pdf_page=1)
+
+    code = codes.first(exam=3, question=2, answer=4)
+    code.page = 5
+    check(codes, page=1)
+    check(codes, page=5)
+
+    code.set_pdf_page(7)
+    check(codes, pdf_page=7)
+    check(codes, exam=3, pdf_page=1)
+
+
+def test_page_code_set_shares_the_indexes():
+    codes = CodeSet()
+    codes.extend(answers())
+    check(codes, page=1)
+
+    # A page index built before the change must not be taken as fresh by a new view
+    codes.first(exam=1).set_page(2)
+    page = PageCodeSet(codes)
+    check(page, page=1)
+    check(page, page=2)
+    check(codes, page=2)
+
+
+def test_random_changes():
+    rng = random.Random(3)
+    pool = answers(exams=5, questions=5)
+    for code in pool:
+        code.page, code.pdf_page = rng.randint(1, 4), rng.randint(1, 8)
+    codes = CodeSet()
+    codes.extend(pool)
+    selection = codes.select(exam=3)
+
+    for _ in range(500):
+        code = rng.choice(pool)
+        action = rng.random()
+        if action < 0.2:
+            code.page = rng.randint(1, 4)
+        elif action < 0.3:
+            code.set_pdf_page(rng.randint(1, 8))
+        elif action < 0.4:
+            codes.remove(code)
+        elif action < 0.5:
+            codes.append(code)
+        elif action < 0.6:
+            code.set_marked(not code.marked)
+        for view in (codes, selection, PageCodeSet(codes)):
+            check(view, exam=code.exam, page=code.page)
+            check(view, pdf_page=code.pdf_page)
+            check(view, type=Code.TYPE_A, question=code.question, marked=True)
@@ -0,0 +1,38 @@
+from qrgrader.code import Code
+from qrgrader.code_set import CodeSet
+from qrgrader.code_table import CodeTable
+
+DETECTED = ("P25010100101,10.00,20.00,30.00,30.00,1,1,0\n"
+            "250101001015,11.00,21.00,15.00,15.00,None,1,1\n"
+            "O25010100103,12.00,22.00,15.00,15.00,1,1,0\n"
+            "N25010100142,13.00,23.00,15.00,15.00,1,2,1\n")
+
+
+def test_append_view_of_another_table():
+    source = CodeTable()
+    source.loads(DETECTED)
+
+    # Views of another table are copied, missing fields (None) included
+    target = CodeTable()
+    for code in source:
+        target.append(code)
+    assert target.dumps() == source.dumps()
+    assert target.columns is not source.columns
+
+    answer = target.first(type=Code.TYPE_A)
+    assert (answer.question, answer.answer, answer.page, answer.number) == (1, 1, None, None)
+    assert target.first(type=Code.TYPE_N).question is None
+
+    # The copy does not write through to the source
+    answer.set_marked(False)
+    assert source.first(type=Code.TYPE_A).marked
+
+
+def test_same_as_code_set():
+    codes, table = CodeSet(), CodeTable()
+    codes.loads(DETECTED.replace("None", "1"))
+    table.loads(DETECTED.replace("None", "1"))
+    assert table.dumps() == codes.dumps()
+    assert table.get_exams() == codes.get_exams()
+    assert table.get_questions() == codes.get_questions()
+    assert [code.data for code in table.select(exam=1, page=1)] == [code.data for code in codes.select(exam=1, page=1)]
@@ -0,0 +1,42 @@
+import os
+
+from qrgrader.journal import Journal
+
+CODES = "P25010100101,10.00,20.00,30.00,30.00,1,1,0\n"
+INFO = {"embedded": False, "size": 15.0}
+
+
+def test_round_trip(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    assert journal.load() == {}
+
+    journal.open()
+    journal.append("scan.pdf", 0, CODES, INFO)
+    journal.append("scan.pdf", 1, "", {"skipped": "no codes"})
+    journal.close()
+    assert journal.load() == {("scan.pdf", 0): (CODES, INFO), ("scan.pdf", 1): ("", {"skipped": "no codes"})}
+
+    journal.close(remove=True)
+    assert not os.path.exists(journal.filename)
+
+
+def test_resume_after_a_crash(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    journal.open()
+    journal.append("scan.pdf", 0, CODES, INFO)
+    journal.close()
+
+    # A line cut in the middle is ignored and does not swallow the next one
+    with open(journal.filename, "a", encoding='utf-8') as f:
+        f.write('{"file": "scan.pdf", "page": 1, "co')
+    assert list(journal.load()) == [("scan.pdf", 0)]
+
+    journal.open(resume=True)
+    journal.append("scan.pdf", 1, CODES, INFO)
+    journal.close()
+    assert journal.load() == {("scan.pdf", 0): (CODES, INFO), ("scan.pdf", 1): (CODES, INFO)}
+
+    # Without resume the journal starts over
+    journal.open()
+    journal.close()
+    assert journal.load() == {}
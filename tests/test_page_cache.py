@@ -0,0 +1,43 @@
+import os
+
+import pymupdf
+
+from qrgrader.page_cache import PageCache
+
+
+def document(*texts):
+    doc = pymupdf.open()
+    for text in texts:
+        doc.new_page().insert_text((72, 72), text)
+    return doc
+
+
+def test_key_changes_with_the_page_and_the_parameters():
+    page = document("exam 1")[0]
+    key = PageCache.key(page, '{"dpi": 400}')
+    assert PageCache.key(document("exam 1")[0], '{"dpi": 400}') == key
+
+    # Another page, other parameters or the same page rotated are all misses
+    assert PageCache.key(document("exam 2")[0], '{"dpi": 400}') != key
+    assert PageCache.key(page, '{"dpi": 300}') != key
+    page.set_rotation(90)
+    assert PageCache.key(page, '{"dpi": 400}') != key
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = PageCache(str(tmp_path) + os.sep, 0)
+    for i, key in enumerate(("a", "b", "c")):
+        cache.put(key, "codes {}".format(key), {"page": i})
+        os.utime(cache.directory + key + ".json", (1000 + i, 1000 + i))
+    size = os.path.getsize(cache.directory + "a.json")
+
+    # Reading "a" makes it the most recent, so "b" and then "c" go first
+    assert cache.get("a") == ("codes a", {"page": 0})
+    cache.max_size = 2 * size
+    cache.evict()
+    assert sorted(os.listdir(cache.directory)) == ["a.json", "c.json"]
+    assert cache.get("b") is None
+
+    cache.max_size = size
+    cache.evict()
+    assert os.listdir(cache.directory) == ["a.json"]
@@ -0,0 +1,37 @@
+from qrgrader.qrscanner import get_page_ranges
+
+# As built by qrscanner: (number, filename, first page, number of pages)
+FILES = [(0, "a.pdf", 0, 40), (1, "b.pdf", 0, 3), (2, "c.pdf", 5, 60)]
+
+
+def pages(ranges):
+    return [(filename, i) for filename, start, end in ranges for i in range(start, end)]
+
+
+def test_every_page_once_never_across_files():
+    ranges = get_page_ranges(FILES, 4)
+    assert pages(ranges) == [(filename, i) for _, filename, first, length in FILES for i in range(first, length)]
+    for filename, start, end in ranges:
+        assert start < end
+        assert end <= {"a.pdf": 40, "b.pdf": 3, "c.pdf": 60}[filename]
+
+
+def test_chunks_shrink_as_work_runs_out():
+    ranges = get_page_ranges([(0, "a.pdf", 0, 200)], 4)
+    sizes = [end - start for _, start, end in ranges]
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[0] == 200 // 8
+    assert sizes[-4:] == [1, 1, 1, 1]
+
+    # Never smaller than min_chunk (except for what is left of a file)
+    sizes = [end - start for _, start, end in get_page_ranges([(0, "a.pdf", 0, 200)], 4, min_chunk=10)]
+    assert min(sizes[:-1]) >= 10
+
+
+def test_skipped_pages_split_the_ranges():
+    skip = {("a.pdf", i) for i in (3, 4, 10)} | {("b.pdf", i) for i in range(3)}
+    ranges = get_page_ranges(FILES, 1, skip=skip)
+    assert not any(filename == "b.pdf" for filename, _, _ in ranges)
+    assert set(pages(ranges)).isdisjoint(skip)
+    assert len(pages(ranges)) == 40 - 3 + 55
+    assert ranges[:3] == [("a.pdf", 0, 3), ("a.pdf", 5, 10), ("a.pdf", 11, 40)]
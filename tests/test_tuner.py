@@ -0,0 +1,51 @@
+from qrgrader.tuner import ThresholdTuner
+
+CANDIDATES = [None, 30, 60, 90]
+
+
+def test_default_order_until_something_works():
+    tuner = ThresholdTuner(CANDIDATES)
+    assert tuner.order("full") == CANDIDATES
+
+    # The one that worked goes first, the others keep the default order
+    tuner.success("full", 60)
+    assert tuner.order("full") == [60, None, 30, 90]
+    assert tuner.order("low") == CANDIDATES
+
+
+def test_recent_successes_win():
+    tuner = ThresholdTuner(CANDIDATES, decay=0.9)
+    for _ in range(3):
+        tuner.success("full", 30)
+
+    # 30 scored 2.71, it decays by 0.9 on every page that 90 works on
+    tuner.success("full", 90)
+    tuner.success("full", 90)
+    assert tuner.order("full")[:2] == [30, 90]
+    tuner.success("full", 90)
+    assert tuner.order("full")[:2] == [90, 30]
+
+
+def test_history_is_only_a_prior():
+    history = {"full": {"90": 100, "30": 50, "unknown": 10}}
+    tuner = ThresholdTuner(CANDIDATES, history=history)
+    assert tuner.order("full") == [90, 30, None, 60]
+
+    # A couple of pages of this batch are enough to change the order
+    tuner.success("full", 60)
+    tuner.success("full", 60)
+    assert tuner.order("full")[0] == 60
+
+
+def test_take_and_disabled():
+    tuner = ThresholdTuner(CANDIDATES)
+    tuner.success("full", None)
+    tuner.success("full", None)
+    tuner.success("low", 30)
+    assert tuner.take() == {"full": {"None": 2}, "low": {"30": 1}}
+    assert tuner.take() == {}
+
+    tuner = ThresholdTuner(CANDIDATES, history={"full": {"90": 1}}, enabled=False)
+    tuner.success("full", 60)
+    assert tuner.order("full") == CANDIDATES
+    assert tuner.take() == {}
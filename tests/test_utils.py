@@ -0,0 +1,38 @@
+import cmath
+
+import pytest
+
+from qrgrader.utils import fit_similarity
+
+# Centers of the codes on the reference page (points)
+REFERENCE = [(50, 60), (300, 60), (550, 60), (50, 400), (300, 400), (550, 400), (50, 780), (550, 780)]
+
+
+def scan(points, scale=1.05, angle=0.02, shift=(12, -7)):
+    # Page scanned slightly bigger, rotated and shifted
+    a, b = scale * cmath.exp(1j * angle), complex(*shift)
+    return [((a * complex(x, y) + b).real, (a * complex(x, y) + b).imag) for x, y in points]
+
+
+def test_exact_transform():
+    transform, residual, inliers = fit_similarity(REFERENCE, scan(REFERENCE), 5)
+    assert residual == pytest.approx(0, abs=1e-9)
+    assert inliers.all()
+    assert transform((100, 200)) == pytest.approx(scan([(100, 200)])[0])
+
+
+def test_misread_is_rejected():
+    # The code found at the fifth place is really another one (a misread pair)
+    scanned = scan(REFERENCE)
+    scanned[4] = scan([(300, 60)])[0]
+    transform, residual, inliers = fit_similarity(REFERENCE, scanned, 5)
+    assert list(inliers) == [True] * 4 + [False] + [True] * 3
+    assert residual == pytest.approx(0, abs=1e-9)
+    assert transform((300, 400)) == pytest.approx(scan([(300, 400)])[0])
+
+
+def test_degenerate_points():
+    # All the pairs are useless for RANSAC: everything is fitted (just a shift)
+    transform, residual, inliers = fit_similarity([(10, 10), (10, 10)], [(15, 5), (15, 5)], 5)
+    assert inliers.all()
+    assert transform((10, 10)) == pytest.approx((15, 5))